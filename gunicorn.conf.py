@@ -0,0 +1,13 @@
+"""gunicorn settings, see Procfile.
+
+    gunicorn 'shigureline:create_app()' -c gunicorn.conf.py
+"""
+
+
+def post_worker_init(worker):
+    # every worker starts its notifier (standing by unless it gets the lock)
+    # when it boots, not on its first webhook, so scheduled notifications go
+    # out right after a deploy or restart. runs after the app is loaded, with
+    # or without --preload
+    import shigureline
+    shigureline.start()
@@ -0,0 +1,637 @@
+"""asyncio counterpart of the webhook app and the notifier.
+
+    pip install -r requirements-async.txt
+    uvicorn --factory shigureasync:create_app
+    python shigureasync.py [--port <port>]
+
+Serves /callback and /metrics like shigureline.py, but weather requests and
+LINE API calls wait on one event loop instead of holding a thread each, so a
+single process can keep thousands of them in flight. Parsing, caching and
+reply rendering are shared with shigurecore, retries with shigureweather and
+the notification waves with shigurenotify; only the I/O is done here. The
+SQLite stores (user settings, forecasts and the weather budget) are blocking
+too and are only called on the default executor.
+"""
+
+import asyncio
+import datetime as dt
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from urllib.parse import parse_qsl
+
+import aiohttp
+from linebot import WebhookParser
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import MessageEvent, TextMessage, LocationMessage
+
+import settings
+import shigurecache
+import shigurecore
+import shigurelimit
+import shigurelog
+import shigurenotify
+import shigurestats
+import shigurestore
+import shiguretrace
+import shigureweather
+from shigurenotify import PUSH_SEND, NOTIFIER_TICK, JST, ONE_MINUTE, seconds_until, minute_of, slot_of
+
+logger = shigurelog.get_logger('async')
+
+WEBHOOK_HANDLING = shigurestats.histogram(
+    'shigure_webhook_seconds', 'Time to answer a webhook request')
+
+
+class AsyncWeatherClient(shigureweather.BaseWeatherClient):
+    # shigureweather.WeatherClient on aiohttp, same retries and back off
+
+    def __init__(self,
+        connect_timeout=settings.WEATHER_CONNECT_TIMEOUT,
+        read_timeout=settings.WEATHER_READ_TIMEOUT,
+        pool_size=settings.ASYNC_CONCURRENCY,
+        **kwargs
+        ):
+        super(AsyncWeatherClient, self).__init__(**kwargs)
+        self.timeout = aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout)
+        self.pool_size = pool_size
+        # created on first use, sessions belong to the running loop
+        self._session = None
+
+    def session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def hourly(self, latitude, longitude, priority=shigurelimit.INTERACTIVE):
+        # returns (HTTP status, decoded json) like WeatherClient.hourly
+        if self.blocked():
+            return 403, None
+        url = self.url(latitude, longitude)
+        attempt = 0
+        while True:
+            # the budget is shared with other processes through SQLite
+            if not await blocking(self.admit, priority):
+                return 429, None
+            status = headers = error = None
+            try:
+                async with self.session().get(url, params=shigureweather.QUERY) as responce:
+                    status = responce.status
+                    if status == 200:
+                        await blocking(self.succeeded)
+                        return status, shigureweather.loads(await responce.read())
+                    headers = responce.headers
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                status = None
+                error = e
+            wait = await blocking(self.retry_wait, attempt, status, headers, error)
+            if wait is None:
+                return status, None
+            attempt += 1
+            await asyncio.sleep(wait)
+
+
+class AsyncSingleFlight:
+    # shigurecache.SingleFlight for coroutines on one loop
+
+    def __init__(self):
+        self._calls = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def start(self, key, fn):
+        # the task running fn() for the key, started unless one is running
+        task = self._calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda t: self._calls.pop(key, None))
+        else:
+            self.followers += 1
+        return task
+
+    async def do(self, key, fn):
+        # a caller giving up doesn't cancel the fetch the others wait for
+        return await asyncio.shield(self.start(key, fn))
+
+
+weather_client = AsyncWeatherClient()
+forecast_flight = AsyncSingleFlight()
+
+
+async def blocking(fn, *args, **kwargs):
+    # runs fn on the default executor, for SQLite and other blocking calls
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, lambda: fn(*args, **kwargs))
+
+
+async def cached_forecast(key):
+    # shigurecore.cached_forecast, reading the forecast store off the loop
+    f = shigurecore.cached_forecast(key, store=False)
+    if f is None and shigurecache.forecast_store is not None:
+        f = await blocking(shigurecore.restored_forecast, key)
+    return f
+
+
+async def stale_forecast(key):
+    f = shigurecore.stale_forecast(key, store=False)
+    if f is None and shigurecache.forecast_store is not None:
+        f = await blocking(shigurecore.stale_forecast, key)
+    return f
+
+
+async def get_forecast(latitude, longitude, priority=shigurelimit.INTERACTIVE, max_age=None):
+    # shigurecore.get_forecast without blocking, sharing its forecast cache
+    if latitude is None or longitude is None:
+        return shigurecore.Forecast(status=shigurecore.Forecast.BAD_REQUEST)
+
+    key = shigurecache.location_key(latitude, longitude)
+    f = await cached_forecast(key)
+    if shigurecore.recent(f, max_age):
+        return f
+
+    if settings.CACHE_REVALIDATE and max_age is None:
+        f = await stale_forecast(key)
+        if f is not None:
+            forecast_flight.start(key, lambda: fetch_forecast(key, priority))
+            return f
+
+    return await forecast_flight.do(key, lambda: fetch_forecast(key, priority, max_age))
+
+
+async def fetch_forecast(key, priority=shigurelimit.INTERACTIVE, max_age=None):
+    f = shigurecache.forecast_cache.peek(key)
+    if shigurecore.recent(f, max_age):
+        return f
+    f = shigurecore.Forecast(latitude=key[0], longitude=key[1])
+    start = time.perf_counter()
+    status, js = await weather_client.hourly(key[0], key[1], priority)
+    f.load(status, js, start=start)
+    if shigurecache.forecast_store is None:
+        return shigurecore.keep_forecast(key, f)
+    return await blocking(shigurecore.keep_forecast, key, f)
+
+
+async def responce(message, latitude=None, longitude=None, trace=shiguretrace.NOOP):
+    # shigurecore.responce, awaiting the forecast instead of blocking on it
+    return await answer(shigurecore.router.route(message), message, latitude, longitude, trace)
+
+
+async def answer(handler, message, latitude, longitude, trace=shiguretrace.NOOP):
+    # the Responce of the handler the message was routed to
+    if not isinstance(handler, shigurecore.ForecastIntent):
+        return handler(message, latitude, longitude)
+    if handler.needs_location and (latitude is None or longitude is None):
+        return shigurecore.UNKOWN_LOCATION_RESPONCE
+    with trace.span('forecast'):
+        f = await get_forecast(latitude, longitude)
+    with trace.span('render', intent=handler.name):
+        return handler.reply(f)
+
+
+class LineApiError(Exception):
+
+    def __init__(self, status, body):
+        super(LineApiError, self).__init__('LINE API returned HTTP {}: {}'.format(status, body))
+        self.status = status
+
+
+class AsyncLineClient:
+    # the LINE messaging API calls the bot makes, on aiohttp
+
+    def __init__(self, channel_access_token,
+        endpoint=settings.LINE_API_ENDPOINT,
+        timeout=settings.LINE_TIMEOUT,
+        pool_size=settings.ASYNC_CONCURRENCY
+        ):
+        self.endpoint = endpoint
+        self.headers = {'Authorization': 'Bearer ' + channel_access_token}
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.pool_size = pool_size
+        self._session = None
+
+    def session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                headers=self.headers,
+                timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _post(self, path, body):
+        async with self.session().post(self.endpoint + path, json=body) as responce:
+            if responce.status != 200:
+                raise LineApiError(responce.status, await responce.text())
+
+    async def reply_message(self, reply_token, text):
+        await self._post('/v2/bot/message/reply', {
+            'replyToken': reply_token,
+            'messages': [{'type': 'text', 'text': text}],
+        })
+
+    async def push_message(self, user_id, text):
+        await self._post('/v2/bot/message/push', {
+            'to': user_id,
+            'messages': [{'type': 'text', 'text': text}],
+        })
+
+    async def multicast(self, user_ids, text):
+        await self._post('/v2/bot/message/multicast', {
+            'to': user_ids,
+            'messages': [{'type': 'text', 'text': text}],
+        })
+
+
+class AsyncDispatcher:
+    # shigurenotify.Dispatcher with every forecast and send of a wave in flight at once
+
+    def __init__(self, line_client,
+        concurrency=settings.ASYNC_CONCURRENCY,
+        multicast_limit=settings.LINE_MULTICAST_LIMIT
+        ):
+        self.line_client = line_client
+        self.concurrency = concurrency
+        self.multicast_limit = multicast_limit
+        self._semaphore = None
+        self.last_run = None
+
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def render(self, key):
+        async with self.semaphore():
+            f = await get_forecast(key[0], key[1], priority=shigurelimit.NOTIFICATION)
+        return shigurecore.umbrella_responce.reply(f)
+
+    async def send(self, user_ids, text):
+        method = 'push' if len(user_ids) == 1 else 'multicast'
+        try:
+            async with self.semaphore():
+                with PUSH_SEND.time(method=method):
+                    if method == 'push':
+                        await self.line_client.push_message(user_ids[0], text)
+                    else:
+                        await self.line_client.multicast(user_ids, text)
+        except (LineApiError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logger.error('failed to send notification to %d users: %r', len(user_ids), e)
+            return None
+        return time.time()
+
+    async def dispatch(self, users, scheduled_at):
+        # users: iterable of (user_id, setting), scheduled_at: unix time
+        wave = shigurenotify.Wave(users, scheduled_at, self.multicast_limit)
+        wave.rendered(await asyncio.gather(*[self.render(key) for key in wave.cells]))
+        delivered = await asyncio.gather(*[self.send(chunk, text) for chunk, text in wave.sends])
+        self.last_run = wave.summary(delivered)
+        logger.info('notification dispatch: %s', self.last_run)
+        return self.last_run
+
+
+class AsyncNotifier:
+    # shigurenotify.Notifier and Prefetcher as tasks on the app's loop
+
+    def __init__(self, line_client, user_settings, lock=None):
+        self.user_settings = user_settings
+        self.lock = lock
+        self.dispatcher = AsyncDispatcher(line_client)
+        self.prefetch_interval = 1 / settings.PREFETCH_RATE
+        self.prefetched = 0
+        self.last_prefetch = None
+        self._changed = None
+
+    def changed(self):
+        # wakes up the schedulers after this process wrote a setting
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        return self._changed
+
+    async def _sleep(self, now, slot):
+        # until the next minute someone wants a notification, or until the
+        # schedule changes; other processes are noticed by polling. returns
+        # when it planned to wake up if the schedule changed, else None
+        try:
+            next_slot = await self._store(self.user_settings.next_slot, slot + 1)
+        except Exception:
+            logger.exception('failed to read the schedule')
+            next_slot = None
+        timeout = seconds_until(now, slot, next_slot)
+        if timeout is None or timeout > settings.SETTINGS_POLL_INTERVAL:
+            timeout = settings.SETTINGS_POLL_INTERVAL
+        try:
+            await asyncio.wait_for(self.changed().wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.changed().clear()
+        return now + dt.timedelta(seconds=timeout)
+
+    async def _store(self, fn, *args):
+        return await blocking(fn, *args)
+
+    async def schedule(self, handle, lead=dt.timedelta(0)):
+        # calls handle(minute) for every occupied minute, lead ahead of the
+        # clock, like shigurenotify.Notifier.loop
+        last = minute_of(dt.datetime.now(JST())) + lead - ONE_MINUTE
+        while True:
+            now = dt.datetime.now(JST()) + lead
+            try:
+                minutes = await self._store(shigurenotify.pending_minutes, self.user_settings, last, minute_of(now))
+            except Exception:
+                logger.exception('failed to read the schedule')
+                minutes = []
+            if minutes:
+                for minute in minutes:
+                    last = minute
+                    try:
+                        await handle(minute)
+                    except Exception:
+                        logger.exception('scheduled work for %s failed', minute)
+                # the clock moved on meanwhile, look again before sleeping
+                continue
+            last = shigurenotify.settled(last, now)
+            planned = await self._sleep(now, slot_of(now))
+            if planned is not None:
+                last = shigurenotify.settled(last, dt.datetime.now(JST()) + lead, planned)
+
+    async def run(self):
+        if self.lock is not None and not self.lock.acquire(blocking=False):
+            logger.info('another notifier is running, standing by')
+            # a blocking acquire on the executor could not be cancelled and
+            # would keep the interpreter from exiting, so poll instead
+            while not self.lock.acquire(blocking=False):
+                await asyncio.sleep(settings.NOTIFIER_STANDBY_INTERVAL)
+        logger.info('start running notifier')
+        if settings.PREFETCH_ENABLED:
+            asyncio.ensure_future(self.prefetcher())
+        if settings.ALERT_ENABLED:
+            asyncio.ensure_future(self.rain_watcher())
+        await self.schedule(self.tick)
+
+    async def tick(self, minute):
+        with NOTIFIER_TICK.time():
+            due = await self._store(self.user_settings.due, slot_of(minute))
+            if due and shigurenotify.claim(self.lock, minute):
+                await self.dispatcher.dispatch(due, minute.timestamp())
+
+    async def prefetch(self, slot):
+        # shigurenotify.Prefetcher.prefetch
+        cells, _ = shigurenotify.group_users(await self._store(self.user_settings.due, slot))
+        fetched = 0
+        for key in cells:
+            if shigurecache.forecast_cache.peek(key) is not None:
+                continue
+            f = await get_forecast(key[0], key[1], priority=shigurelimit.PREFETCH)
+            if shigurenotify.budget_spent(f):
+                break
+            fetched += 1
+            # stay well under the API quota
+            await asyncio.sleep(self.prefetch_interval)
+        if cells:
+            self.prefetched += fetched
+            self.last_prefetch = shigurenotify.prefetch_summary(slot, cells, fetched)
+
+    async def prefetcher(self):
+        await self.schedule(
+            lambda minute: self.prefetch(slot_of(minute)),
+            dt.timedelta(minutes=settings.PREFETCH_LEAD_MINUTES))
+
+    async def check_rain(self, alerts):
+        # shigurenotify.RainWatcher.check
+        start = time.time()
+        cells = list(await self._store(self.user_settings.alert_cells))
+        changed = alerts.check(cells, await asyncio.gather(*[
+            get_forecast(key[0], key[1], priority=shigurelimit.NOTIFICATION, max_age=settings.ALERT_INTERVAL_MINUTES * 60)
+            for key in cells]))
+
+        sends = []
+        for key, f in changed:
+            user_ids = await self._store(self.user_settings.alert_users, key)
+            sends.extend(
+                (chunk, shigurenotify.alert_text(f))
+                for chunk in shigurenotify.chunks(user_ids, self.dispatcher.multicast_limit))
+        delivered = await asyncio.gather(*[self.dispatcher.send(chunk, text) for chunk, text in sends])
+        return shigurenotify.alert_summary(start, cells, changed, sends, delivered)
+
+    async def rain_watcher(self):
+        alerts = shigurenotify.RainAlerts()
+        while True:
+            hour = dt.datetime.now(JST()).hour
+            if settings.ALERT_START_HOUR <= hour < settings.ALERT_END_HOUR:
+                try:
+                    await self.check_rain(alerts)
+                except Exception:
+                    logger.exception('rain alert check failed')
+            await asyncio.sleep(settings.ALERT_INTERVAL_MINUTES * 60)
+
+
+async def read_body(receive):
+    body = b''
+    more = True
+    while more:
+        message = await receive()
+        body += message.get('body', b'')
+        more = message.get('more_body', False)
+    return body
+
+
+async def respond(send, status, body, content_type='text/plain; charset=utf-8'):
+    body = body.encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', content_type.encode('latin-1')),
+            (b'content-length', str(len(body)).encode('latin-1')),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class WebhookApp:
+    # ASGI application, answers LINE right away and replies from tasks
+
+    def __init__(self, channel_secret, channel_access_token):
+        self.parser = WebhookParser(channel_secret)
+        self.line_client = AsyncLineClient(channel_access_token)
+        self.user_settings = None
+        self.notifier = None
+        self.lock = None
+        self.tasks = set()
+
+    async def startup(self):
+        self.user_settings = shigurestore.open_store()
+        if settings.NOTIFIER_EMBEDDED:
+            self.lock = shigurenotify.NotifierLock()
+            self.notifier = AsyncNotifier(self.line_client, self.user_settings, self.lock)
+            self.spawn(self.notifier.run())
+
+    async def shutdown(self):
+        pending = [t for t in self.tasks if not t.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        await self.line_client.close()
+        await weather_client.close()
+        if self.lock is not None:
+            self.lock.release()
+        self.user_settings.close()
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('webhook task failed', exc_info=task.exception())
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await self.startup()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await self.shutdown()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        if self.user_settings is None:
+            # servers without lifespan support
+            await self.startup()
+        path = scope['path']
+        if path == '/callback' and scope['method'] == 'POST':
+            await self.callback(scope, receive, send)
+        elif path == '/metrics':
+            await respond(send, 200, shigurestats.registry.render(), 'text/plain; version=0.0.4')
+        elif path.startswith('/admin/'):
+            await self.admin(scope, send)
+        else:
+            await respond(send, 404, 'Not Found')
+
+    async def admin(self, scope, send):
+        headers = dict(scope['headers'])
+        authorization = headers.get(b'authorization', b'').decode('latin-1')
+        params = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        # profiling blocks, keep it off the loop it is watching
+        status, text = await blocking(
+            shiguretrace.admin, scope['path'][len('/admin/'):], scope['method'], params, authorization)
+        await respond(send, status, text)
+
+    async def callback(self, scope, receive, send):
+        trace = shiguretrace.start()
+        with WEBHOOK_HANDLING.time(), trace.span('webhook'):
+            headers = dict(scope['headers'])
+            signature = headers.get(b'x-line-signature')
+            body = (await read_body(receive)).decode('utf-8')
+            logger.debug('request body: %s', body)
+            try:
+                if signature is None:
+                    raise InvalidSignatureError('no signature')
+                with trace.span('parse', bytes=len(body)):
+                    events = self.parser.parse(body, signature.decode('latin-1'))
+            except InvalidSignatureError:
+                await respond(send, 400, 'Bad Request')
+                return
+            for event in events:
+                self.spawn(self.handle_event(event))
+        await respond(send, 200, 'OK')
+
+    async def handle_event(self, event):
+        if not isinstance(event, MessageEvent):
+            return
+        trace = shiguretrace.start()
+        with trace.span('event'):
+            await self._handle_event(event, trace)
+
+    async def _handle_event(self, event, trace):
+        user_id = event.source.user_id
+        message = event.message
+        logger.info('recieved message from %s', user_id)
+
+        if isinstance(message, TextMessage):
+            handler = shigurecore.router.route(message.text)
+            if isinstance(handler, shigurecore.SettingIntent):
+                text, changes = handler.request(message.text)
+                if changes is not None:
+                    await self.update_setting(user_id, **changes)
+            else:
+                with trace.span('settings'):
+                    setting = await self.store(self.user_settings.get, user_id) or {}
+                r = await answer(
+                    handler,
+                    message.text,
+                    setting.get('latitude'),
+                    setting.get('longitude'),
+                    trace=trace)
+                text = shigurecore.reply_text(r)
+        elif isinstance(message, LocationMessage):
+            await self.update_setting(user_id, latitude=message.latitude, longitude=message.longitude)
+            text = shigurecore.LOCATION_SAVED_MESSAGE
+        else:
+            return
+
+        with trace.span('reply'):
+            await self.line_client.reply_message(event.reply_token, text)
+
+    async def store(self, fn, *args, **kwargs):
+        return await blocking(fn, *args, **kwargs)
+
+    async def update_setting(self, user_id, **values):
+        if not user_id:
+            return
+        previous = await self.store(self.user_settings.update, user_id, **values)
+        logger.info('%s user setting [%s]: %s',
+            'added' if previous is None else 'overwrited', user_id, values)
+        if self.notifier is not None:
+            self.notifier.changed().set()
+
+
+def create_app(channel_secret=None, channel_access_token=None):
+    # the ASGI app, see the module docstring. nothing is started until the
+    # server sends the lifespan startup event or the first request
+    shigurelog.configure()
+
+    # get channel_secret and channel_access_token from your environment variable
+    channel_secret = channel_secret or os.getenv('LINE_CHANNEL_SECRET', None)
+    channel_access_token = channel_access_token or os.getenv('LINE_CHANNEL_ACCESS_TOKEN', None)
+    if channel_secret is None:
+        raise RuntimeError('Specify LINE_CHANNEL_SECRET as environment variable.')
+    if channel_access_token is None:
+        raise RuntimeError('Specify LINE_CHANNEL_ACCESS_TOKEN as environment variable.')
+    return WebhookApp(channel_secret, channel_access_token)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    arg_parser = ArgumentParser(
+        usage='Usage: python ' + __file__ + ' [--port <port>] [--help]'
+    )
+    arg_parser.add_argument('-p', '--port', type=int, default=8000, help='port')
+    options = arg_parser.parse_args()
+
+    try:
+        app = create_app()
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+    uvicorn.run(app, port=options.port)
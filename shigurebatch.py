@@ -0,0 +1,219 @@
+"""Rain outlook of many locations at once.
+
+    python shigurebatch.py locations.csv -o outlook.csv
+    python shigurebatch.py - --format jsonl < locations.jsonl > outlook.jsonl
+
+Rows need latitude and longitude (CSV columns or JSON keys), other fields are
+passed through and the outlook of the location's cell is added to them. Rows
+are read and written one at a time in input order, so inputs larger than
+memory are fine; locations in the same cell share one forecast request.
+
+From Python, BatchEvaluator().evaluate(rows) does the same for any iterable
+of dicts.
+"""
+
+import collections
+import csv
+import json
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import settings
+import shigurecache
+import shigurecore
+import shigurelimit
+import shigurelog
+import shigureweather
+from shigurecore import Forecast
+
+logger = shigurelog.get_logger('batch')
+
+# added to every row
+FIELDS = ('cell_latitude', 'cell_longitude', 'status', 'rain_level', 'rain_begin', 'max_pop')
+# rows without a usable location
+BAD_LOCATION = dict(zip(FIELDS, (None, None, Forecast.STATUS_NAMES[Forecast.BAD_REQUEST], Forecast.RAIN_UNKOWN, None, None)))
+PROGRESS_ROWS = 10000
+
+
+def read_csv(stream):
+    return csv.DictReader(stream)
+
+
+def read_jsonl(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+class CSVWriter:
+    # the header is taken from the first row
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.writer = None
+
+    def write(self, row):
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.stream, fieldnames=list(row), extrasaction='ignore')
+            self.writer.writeheader()
+        self.writer.writerow(row)
+
+
+class JSONLWriter:
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, row):
+        self.stream.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+WRITERS = {'csv': CSVWriter, 'jsonl': JSONLWriter}
+
+
+def location(row):
+    # cell of the row, None when it has no usable coordinates
+    try:
+        return shigurecache.location_key(row['latitude'], row['longitude'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def outlook(key, f):
+    begin = f.rain_begin_time
+    return {
+        'cell_latitude': key[0],
+        'cell_longitude': key[1],
+        'status': Forecast.STATUS_NAMES[f.status],
+        'rain_level': f.rain_level,
+        'rain_begin': begin.isoformat() if begin is not None else None,
+        'max_pop': f.max_pop,
+    }
+
+
+class BatchEvaluator:
+    # fetches the forecasts of upcoming rows while earlier rows are written.
+    # at most window rows and max_cells outlooks are held at any time.
+
+    def __init__(self,
+        priority=shigurelimit.PREFETCH,
+        concurrency=settings.BATCH_CONCURRENCY,
+        window=settings.BATCH_WINDOW,
+        max_cells=settings.BATCH_MAX_CELLS,
+        max_wait=settings.BATCH_MAX_WAIT
+        ):
+        self.priority = priority
+        self.concurrency = concurrency
+        self.window = window
+        self.max_cells = max_cells
+        self.max_wait = max_wait
+        # cell -> future of its outlook, least recently used first
+        self.cells = collections.OrderedDict()
+        self.rows = 0
+        self.requested = 0
+        self.statuses = collections.Counter()
+
+    def forecast(self, key):
+        start = time.time()
+        attempt = 0
+        while True:
+            f = shigurecore.get_forecast(key[0], key[1], priority=self.priority)
+            if f.status != Forecast.API_LIMIT_EXCEEDED or time.time() - start >= self.max_wait:
+                return outlook(key, f)
+            # out of budget for now, go on as the budget refills
+            time.sleep(shigureweather.backoff(attempt, 1.0, 30.0))
+            attempt += 1
+
+    def cell(self, pool, key):
+        future = self.cells.get(key)
+        if future is not None:
+            self.cells.move_to_end(key)
+            return future
+        future = self.cells[key] = pool.submit(self.forecast, key)
+        self.requested += 1
+        if len(self.cells) > self.max_cells:
+            self.cells.popitem(last=False)
+        return future
+
+    def result(self, row, future):
+        row.update(BAD_LOCATION if future is None else future.result())
+        self.rows += 1
+        self.statuses[row['status']] += 1
+        return row
+
+    def evaluate(self, rows):
+        # yields the rows with their outlook, in input order
+        pending = collections.deque()
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            for row in rows:
+                key = location(row)
+                pending.append((row, None if key is None else self.cell(pool, key)))
+                while pending and (len(pending) > self.window or pending[0][1] is None or pending[0][1].done()):
+                    yield self.result(*pending.popleft())
+            while pending:
+                yield self.result(*pending.popleft())
+
+    def stats(self):
+        return {
+            'rows': self.rows,
+            'cells': self.requested,
+            'statuses': dict(self.statuses),
+        }
+
+
+def guess_format(path, default='jsonl'):
+    if path == '-':
+        return default
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+def main():
+    parser = ArgumentParser(description='Rain outlook of every location in a CSV or JSON lines file.')
+    parser.add_argument('input', help="CSV or JSON lines file, '-' for stdin")
+    parser.add_argument('-o', '--output', default='-', help="file to write, '-' for stdout (default)")
+    parser.add_argument('--format', choices=sorted(READERS), help='input format, guessed from the file name')
+    parser.add_argument('--output-format', choices=sorted(WRITERS), help='output format, the input format by default')
+    parser.add_argument('--priority', choices=shigurelimit.PRIORITY_NAMES, default='prefetch',
+        help='weather API budget to spend (default: prefetch, leaving the rest to the bot)')
+    parser.add_argument('--concurrency', type=int, default=settings.BATCH_CONCURRENCY)
+    args = parser.parse_args()
+    # the output may go to stdout
+    shigurelog.configure(stream=sys.stderr)
+
+    input_format = args.format or guess_format(args.input)
+    output_format = args.output_format or guess_format(args.output, input_format)
+    source = sys.stdin if args.input == '-' else open(args.input, newline='', encoding='utf-8')
+    target = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+
+    evaluator = BatchEvaluator(
+        priority=shigurelimit.PRIORITY_NAMES.index(args.priority),
+        concurrency=args.concurrency)
+    writer = WRITERS[output_format](target)
+    start = time.time()
+    try:
+        for row in evaluator.evaluate(READERS[input_format](source)):
+            writer.write(row)
+            if evaluator.rows % PROGRESS_ROWS == 0:
+                target.flush()
+                logger.info('evaluated %d rows, %d cells (%.0f rows/s)',
+                    evaluator.rows, evaluator.requested, evaluator.rows / (time.time() - start))
+    finally:
+        target.flush()
+        if target is not sys.stdout:
+            target.close()
+        if source is not sys.stdin:
+            source.close()
+
+    summary = evaluator.stats()
+    summary['duration'] = time.time() - start
+    summary['weather'] = shigureweather.weather_client().stats()
+    summary['budget'] = shigurelimit.weather_limiter.stats()
+    logger.info('batch finished: %s', summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+import collections
+import datetime as dt
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import settings
+import shigurelog
+import shigurestats
+
+logger = shigurelog.get_logger('cache')
+
+
+def location_key(latitude, longitude, precision=settings.CACHE_GRID_PRECISION):
+    # users within the same grid cell share one forecast
+    return (round(float(latitude), precision), round(float(longitude), precision))
+
+
+def forecast_expiry(forecast, now=None, refresh_hours=settings.FORECAST_REFRESH_HOURS):
+    # a forecast is fetched again refresh_hours after the first hour it was
+    # fetched for, until then it is moved forward hour by hour
+    if now is None:
+        now = time.time()
+    fetched_start = forecast.time_start - dt.timedelta(hours=forecast.offset)
+    expires = (fetched_start + dt.timedelta(hours=refresh_hours)).timestamp()
+    if expires <= now:
+        # never hand out an entry that is already expired,
+        # keep it until the next hour boundary instead
+        expires = now - now % 3600 + 3600
+    return expires
+
+
+class ForecastCache:
+
+    def __init__(self, max_entries=settings.CACHE_MAX_ENTRIES, max_stale=settings.CACHE_MAX_STALE):
+        self.max_entries = max_entries
+        # expired forecasts are kept this long as a fallback, see stale()
+        self.max_stale = max_stale
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now=None):
+        if now is None:
+            now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            forecast, expires = entry
+            if expires <= now:
+                if expires + self.max_stale <= now:
+                    del self._entries[key]
+                    self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return forecast
+
+    def peek(self, key, now=None):
+        # lookup without touching the counters or the LRU order
+        if now is None:
+            now = time.time()
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= now:
+            return None
+        return entry[0]
+
+    def stale(self, key, now=None):
+        # an expired forecast for when no fresh one can be fetched
+        if now is None:
+            now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] + self.max_stale <= now:
+                return None
+            self.stale_hits += 1
+            return entry[0]
+
+    def put(self, key, forecast, now=None):
+        expires = forecast_expiry(forecast, now)
+        with self._lock:
+            self._entries[key] = (forecast, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ForecastStore:
+    # forecasts in a SQLite database shared by every process on the host and
+    # kept across restarts, the tier below ForecastCache. a row is the
+    # forecast's record() (48 PoP bytes and two integers) and its expiry
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS forecasts ('
+        ' latitude REAL,'
+        ' longitude REAL,'
+        ' time_start INTEGER,'
+        ' utc_offset INTEGER,'
+        ' pop BLOB,'
+        ' expires REAL,'
+        ' PRIMARY KEY (latitude, longitude)) WITHOUT ROWID',
+    )
+    # drop long expired rows every this many writes
+    PRUNE_INTERVAL = 1000
+
+    def __init__(self, path=settings.FORECAST_DB_PATH, max_stale=settings.CACHE_MAX_STALE):
+        self.path = path
+        self.max_stale = max_stale
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._local = threading.local()
+        self._ready = False
+
+    def _db(self):
+        # sqlite connections can't be shared between threads, nor with a
+        # process forked after importing this module, so they are opened on
+        # first use by each thread of each process
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(
+                self.path,
+                timeout=settings.FORECAST_DB_TIMEOUT,
+                isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            if not self._ready:
+                for statement in ForecastStore.SCHEMA:
+                    db.execute(statement)
+                self._ready = True
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def __len__(self):
+        return self._db().execute('SELECT COUNT(*) FROM forecasts').fetchone()[0]
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    def get(self, key, stale=False, now=None):
+        # the record of a cell, None when missing or expired (longer than
+        # max_stale ago when stale is set)
+        if now is None:
+            now = time.time()
+        try:
+            row = self._db().execute(
+                'SELECT time_start, utc_offset, pop, expires FROM forecasts'
+                ' WHERE latitude = ? AND longitude = ?',
+                key).fetchone()
+        except sqlite3.OperationalError as e:
+            # locked longer than FORECAST_DB_TIMEOUT, fetch it instead
+            logger.warning('forecast store lookup failed: %s', e)
+            row = None
+        if row is None or row[3] + (self.max_stale if stale else 0) <= now:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0:3]
+
+    def put(self, key, forecast, now=None):
+        db = self._db()
+        try:
+            db.execute(
+                'INSERT OR REPLACE INTO forecasts'
+                ' (latitude, longitude, time_start, utc_offset, pop, expires)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                key + forecast.record() + (forecast_expiry(forecast, now),))
+        except sqlite3.OperationalError as e:
+            # the forecast is still cached in memory
+            logger.warning('failed to store forecast of %s: %s', key, e)
+            return
+        self.writes += 1
+        if self.writes % ForecastStore.PRUNE_INTERVAL == 0:
+            db.execute(
+                'DELETE FROM forecasts WHERE expires < ?',
+                ((time.time() if now is None else now) - self.max_stale,))
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # concurrent calls for the same key share the result of one call
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        return {
+            'in_flight': len(self._calls),
+            'calls': self.calls,
+            'shared': self.shared,
+        }
+
+
+class Revalidator:
+    # refreshes entries in the background, at most one refresh per key
+
+    def __init__(self, workers=settings.CACHE_REVALIDATE_WORKERS):
+        self.submitted = 0
+        self.failures = 0
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, key, fn):
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+            self.submitted += 1
+        self._pool.submit(self._run, key, fn)
+        return True
+
+    def _run(self, key, fn):
+        try:
+            fn()
+        except Exception:
+            self.failures += 1
+            logger.exception('failed to refresh %s', key)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+
+forecast_cache = ForecastCache()
+forecast_flight = SingleFlight()
+forecast_revalidator = Revalidator()
+forecast_store = ForecastStore() if settings.FORECAST_DB_PATH else None
+
+shigurestats.counter_callback(
+    'shigure_forecast_cache_lookups_total', 'Forecast cache lookups by result',
+    lambda: {'hit': forecast_cache.hits, 'miss': forecast_cache.misses}, ('result',))
+shigurestats.counter_callback(
+    'shigure_forecast_cache_stale_total', 'Expired forecasts served because no fresh one could be fetched',
+    lambda: forecast_cache.stale_hits)
+shigurestats.counter_callback(
+    'shigure_forecast_store_lookups_total', 'Forecast store lookups after a forecast cache miss, by result',
+    lambda: {'hit': forecast_store.hits, 'miss': forecast_store.misses} if forecast_store else None,
+    ('result',))
+shigurestats.counter_callback(
+    'shigure_forecast_cache_evictions_total', 'Forecasts evicted to stay under CACHE_MAX_ENTRIES',
+    lambda: forecast_cache.evictions)
+shigurestats.gauge_callback(
+    'shigure_forecast_cache_entries', 'Forecasts in the cache',
+    lambda: len(forecast_cache))
+shigurestats.gauge_callback(
+    'shigure_forecast_cache_hit_ratio', 'Hits per forecast cache lookup',
+    lambda: forecast_cache.stats()['hit_ratio'])
+shigurestats.counter_callback(
+    'shigure_forecast_fetches_shared_total', 'Forecast fetches answered by an in-flight fetch',
+    lambda: forecast_flight.shared)
+shigurestats.counter_callback(
+    'shigure_forecast_revalidations_total', 'Expired forecasts refreshed in the background',
+    lambda: forecast_revalidator.submitted)
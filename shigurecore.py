@@ -1,8 +1,22 @@
-import requests
-import json
+import array
+import collections
+import re
 import settings
+import shigurecache
+import shigurelimit
+import shigurelog
+import shigurestats
+import shiguretrace
+import shigureweather
+import time
 import datetime as dt
 
+logger = shigurelog.get_logger('core')
+
+FORECAST_FETCH = shigurestats.histogram(
+    'shigure_forecast_fetch_seconds', 'Forecast fetch latency by result', ('status',))
+
+
 class Forecast:
 
     # Forecast Status
@@ -13,6 +27,17 @@ class Forecast:
     NOT_FOUND = 4
     INTERNAL_SERVER_ERROR = 5
     READY = 6
+    UNAVAILABLE = 7
+    STATUS_NAMES = [
+        'OK',
+        'Bad Request',
+        'Unauthorized',
+        'API Limit Exceeded',
+        'Not Found',
+        'Internal Server Error',
+        'Ready',
+        'Service Unavailable'
+    ]
 
     # probabirity level of rain
     RAIN_UNKOWN = -1
@@ -28,6 +53,23 @@ class Forecast:
         settings.POP_THRESHOLD_ALMOST
     ]
 
+    # forecasts are kept in the cache in large numbers, so keep them small
+    __slots__ = (
+        'status',
+        'pop',
+        'time_start',
+        'latitude',
+        'longitude',
+        'rain_level',
+        'rain_begin_hour',
+        'max_pop',
+        'max_pop_hour',
+        'replies',
+        'horizon',
+        'offset',
+        'fetched_at'
+    )
+
     def __init__(self,
         status=READY,
         pop=None,
@@ -36,27 +78,40 @@ class Forecast:
         latitude=0,
         longitude=0
         ):
+        # time_end is derived from time_start and pop and is only accepted
+        # so existing callers keep working
         self.status = status
-        self.pop = pop
-        if pop is None:
-            self.pop = []
+        # PoP (%) for each hour from time_start
+        self.pop = array.array('b', pop or [])
         self.time_start = time_start
-        self.time_end = time_end
         self.latitude = latitude
         self.longitude = longitude
         self.rain_level = Forecast.RAIN_UNKOWN
-        self.rain_begin_time = None
-        
+        # hours from time_start until the rain begins
+        self.rain_begin_hour = None
+        self.max_pop = None
+        self.max_pop_hour = None
+        # rendered Responce by intent, shared by everyone asking about this forecast
+        self.replies = {}
+        # PoP of every fetched hour, pop starts offset hours into it
+        self.horizon = self.pop
+        self.offset = 0
+        # unix time the PoP was fetched, None when unknown (loaded from the store)
+        self.fetched_at = None
+
+    @property
+    def time_end(self):
+        if self.time_start is None or not self.pop:
+            return None
+        return self.time_start + dt.timedelta(hours=len(self.pop) - 1)
+
+    @property
+    def rain_begin_time(self):
+        if self.rain_begin_hour is None:
+            return None
+        return self.time_start + dt.timedelta(hours=self.rain_begin_hour)
+
     def __str__(self):
-        status = [
-            'OK',
-            'Bad Request',
-            'Unauthorized',
-            'API Limit Exceeded',
-            'Not Found',
-            'Internal Server Error',
-            'Ready']
-        
         levels = [
             'Never',
             'Hardly',
@@ -73,91 +128,349 @@ class Forecast:
             'PoP: {}\n' \
             'rain level: {}\n' \
             'rain begin time: {}\n'.format(
-                status[self.status],
+                Forecast.STATUS_NAMES[self.status],
                 self.latitude,
                 self.longitude,
                 self.time_start,
                 self.time_end,
-                self.pop,
+                list(self.pop),
                 levels[self.rain_level],
                 self.rain_begin_time
             )
 
         return s
 
-    def get(self, latitude, longitude, length=settings.FORECAST_LENGTH):
+    def get(self, latitude, longitude, length=settings.FORECAST_LENGTH, priority=shigurelimit.INTERACTIVE):
         self.latitude = latitude
         self.longitude = longitude
-        url = settings.WEATHER_ENDPOINT.format(
-            username=settings.WEATHER_USERNAME,
-            password=settings.WEATHER_PASSWORD,
-            latitude=latitude,
-            longitude=longitude)
-        payload = {
-            'language': 'en-US',
-            'units': 'm'
-        }
-        responce = requests.get(url, params=payload)
-        status = responce.status_code
-
-        if (status == 400):
+        start = time.perf_counter()
+        status, js = shigureweather.weather_client().hourly(latitude, longitude, priority)
+        self.load(status, js, length, start)
+
+    def load(self, status, js, length=settings.FORECAST_LENGTH, start=None):
+        # set the result of a weather API request, sent at start (perf_counter)
+        if (status is None):
+            # timed out or could not connect even after retrying
+            self.status = Forecast.UNAVAILABLE
+        elif (status == 400):
             # HTTP 400 Bad Request
             self.status = Forecast.BAD_REQUEST
         elif (status == 401):
             # HTTP 401 Unauthorized
             self.status = Forecast.UNAUTHORIZED
-        elif (status == 403):
-            # HTTP 403 Forbidden Request
+        elif (status == 403 or status == 429):
+            # HTTP 403 Forbidden Request / HTTP 429 Too Many Requests
             self.status = Forecast.API_LIMIT_EXCEEDED
         elif (status == 404):
             # HTTP 404 Not Found
             self.status = Forecast.NOT_FOUND
-        elif (status == 500):
-            # HTTP 500 Internal Server Error
+        elif (status >= 500):
+            # HTTP 5xx Internal Server Error
             self.status = Forecast.INTERNAL_SERVER_ERROR
         elif (status == 200):
             # HTTP 200 OK
             self.status = Forecast.OK
+            self.fetched_at = time.time()
 
-            # get json from responce
-            js = responce.json()
-            forecasts = js['forecasts']
+            self.parse(js, length)
+
+        if start is not None:
+            FORECAST_FETCH.observe(
+                time.perf_counter() - start,
+                status=Forecast.STATUS_NAMES[self.status])
 
-            # set time
+    def parse(self, js, length=settings.FORECAST_LENGTH):
+        # the start time and the PoP of every hour, the first hours are evaluated
+        with shiguretrace.span('forecast.parse'):
+            forecasts = js['forecasts']
             length = max(min(len(forecasts), length), 2)
-            self.time_start = dt.datetime.strptime(
-                forecasts[0]['fcst_valid_local'],
-                '%Y-%m-%dT%H:%M:%S%z')
-            self.time_end = dt.datetime.strptime(
-                forecasts[length - 1]['fcst_valid_local'],
-                '%Y-%m-%dT%H:%M:%S%z')
-
-            # set PoP
-            pop = []
-            for f in forecasts[0:length]:
-                pop.append(f['pop'])
-            self.pop = pop
-
-            # set rain level
-            max_pop = max(pop)
-            level = 0
-            for t in Forecast.RAIN_THRESHOLDS:
-                if(max_pop < t):
+            self.time_start = parse_local_time(forecasts[0]['fcst_valid_local'])
+            self.horizon = array.array('b', [f['pop'] for f in forecasts])
+            self.offset = 0
+            self.pop = self.horizon[0:length]
+            evaluate_forecasts([self])
+
+    def window(self, start_hour, length=settings.FORECAST_LENGTH):
+        # the forecast for length hours from start_hour hours after time_start,
+        # cut from the fetched hours without a request. None when they don't
+        # reach that far
+        offset = self.offset + start_hour
+        if offset < 0 or offset + 2 > len(self.horizon):
+            return None
+        f = Forecast(
+            status=self.status,
+            time_start=self.time_start + dt.timedelta(hours=start_hour),
+            latitude=self.latitude,
+            longitude=self.longitude)
+        f.horizon = self.horizon
+        f.offset = offset
+        f.fetched_at = self.fetched_at
+        f.pop = self.horizon[offset:offset + length]
+        evaluate_forecasts([f])
+        return f
+
+    def current(self, now=None):
+        # an older forecast moved forward to start at the next hour like a
+        # fresh one would, None when the fetched hours ran out
+        if now is None:
+            now = time.time()
+        hours = int((now + 3600 - self.time_start.timestamp()) // 3600)
+        if hours <= 0:
+            return self
+        return self.window(hours)
+
+    def record(self):
+        # (first fetched hour as unix time, its UTC offset in minutes, PoP bytes)
+        # as kept by the forecast store
+        start = self.time_start - dt.timedelta(hours=self.offset)
+        return (
+            int(start.timestamp()),
+            int(start.utcoffset().total_seconds()) // 60,
+            self.horizon.tobytes())
+
+    @classmethod
+    def from_record(cls, key, record, length=settings.FORECAST_LENGTH):
+        time_start, utc_offset, pop = record
+        f = cls(
+            status=Forecast.OK,
+            time_start=dt.datetime.fromtimestamp(time_start, timezone(utc_offset)),
+            latitude=key[0],
+            longitude=key[1])
+        f.horizon = array.array('b')
+        f.horizon.frombytes(pop)
+        f.pop = f.horizon[0:length]
+        evaluate_forecasts([f])
+        return f
+
+
+_timezones = {}
+
+
+def timezone(minutes):
+    # shared tzinfo for a UTC offset in minutes
+    tz = _timezones.get(minutes)
+    if tz is None:
+        tz = _timezones[minutes] = dt.timezone(dt.timedelta(minutes=minutes))
+    return tz
+
+
+def parse_local_time(s):
+    # much faster than strptime for the fixed '2017-06-10T07:00:00+0900' format
+    offset = s[19:]
+    tz = _timezones.get(offset)
+    if tz is None:
+        minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+        if offset[0] == '-':
+            minutes = -minutes
+        tz = _timezones[offset] = timezone(minutes)
+    return dt.datetime(
+        int(s[0:4]), int(s[5:7]), int(s[8:10]),
+        int(s[11:13]), int(s[14:16]), int(s[17:19]),
+        tzinfo=tz)
+
+
+RainEvaluation = collections.namedtuple(
+    'RainEvaluation', ['level', 'begin_hour', 'max_pop', 'max_pop_hour'])
+
+# numpy is optional and not in requirements.txt: the bot evaluates one
+# forecast at a time, and numpy only pays off from this many series at once
+# (evaluate_rain called directly on a batch). it is imported on the first
+# such batch, not with this module
+NUMPY_MIN_SERIES = 32
+np = None
+_numpy_missing = False
+
+
+def _load_numpy():
+    global np, _THRESHOLDS, _numpy_missing
+    if np is None and not _numpy_missing:
+        try:
+            import numpy
+        except ImportError:
+            _numpy_missing = True
+            return False
+        _THRESHOLDS = numpy.array(Forecast.RAIN_THRESHOLDS, dtype=numpy.int16)
+        np = numpy
+    return np is not None
+
+
+def _evaluate_rain_python(pops):
+    thresholds = Forecast.RAIN_THRESHOLDS
+    result = RainEvaluation([], [], [], [])
+    for pop in pops:
+        max_pop = max(pop)
+        level = 0
+        for t in thresholds:
+            if max_pop < t:
+                break
+            level += 1
+
+        begin_level = min(Forecast.RAIN_LIKELY, level)
+        begin_hour = -1
+        if begin_level >= Forecast.RAIN_HARDLY:
+            threshold = thresholds[begin_level - 1]
+            begin_hour = 0
+            for p in pop:
+                if p > threshold:
                     break
-                level += 1
-            self.rain_level = level
-            
-            # set rain begin time
-            level = min(Forecast.RAIN_LIKELY, self.rain_level)
-            if level >= Forecast.RAIN_HARDLY:
-                threshold = Forecast.RAIN_THRESHOLDS[level - 1]
-                hour = 0
-                for pop in self.pop:
-                    if (pop > threshold):
-                        break
-                    hour += 1
-                self.rain_begin_time = self.time_start + dt.timedelta(hours=hour)
-            
+                begin_hour += 1
+
+        result.level.append(level)
+        result.begin_hour.append(begin_hour)
+        result.max_pop.append(max_pop)
+        result.max_pop_hour.append(pop.index(max_pop))
+    return result
+
+
+def _evaluate_rain_numpy(pops):
+    lengths = np.fromiter((len(pop) for pop in pops), dtype=np.int64, count=len(pops))
+    hours = int(lengths.max())
+    # shorter series are padded with -1, which never exceeds a threshold
+    p = np.full((len(pops), hours), -1, dtype=np.int16)
+    for i, pop in enumerate(pops):
+        p[i, :len(pop)] = pop
+
+    max_pop = p.max(axis=1)
+    max_pop_hour = p.argmax(axis=1)
+    # number of thresholds reached by the max PoP
+    level = np.searchsorted(_THRESHOLDS, max_pop, side='right')
+
+    # the first hour above the threshold one below the level (at most RAIN_LIKELY)
+    begin_level = np.minimum(level, Forecast.RAIN_LIKELY)
+    threshold = _THRESHOLDS[np.maximum(begin_level - 1, 0)]
+    exceeded = p > threshold[:, None]
+    begin_hour = np.where(exceeded.any(axis=1), exceeded.argmax(axis=1), lengths)
+    begin_hour = np.where(begin_level >= Forecast.RAIN_HARDLY, begin_hour, -1)
+    return RainEvaluation(level, begin_hour, max_pop, max_pop_hour)
+
+
+def evaluate_rain(pops):
+    # rain level, first hour of rain (-1 for none), max PoP and its hour
+    # for many PoP series (locations x hours) at once
+    if len(pops) == 0:
+        return RainEvaluation([], [], [], [])
+    if len(pops) < NUMPY_MIN_SERIES or not _load_numpy():
+        return _evaluate_rain_python(pops)
+    return _evaluate_rain_numpy(pops)
+
+
+def evaluate_forecasts(forecasts):
+    # set rain level and rain begin time of fetched forecasts in one pass
+    r = evaluate_rain([f.pop for f in forecasts])
+    for i, f in enumerate(forecasts):
+        f.rain_level = int(r.level[i])
+        f.max_pop = int(r.max_pop[i])
+        f.max_pop_hour = int(r.max_pop_hour[i])
+        begin_hour = int(r.begin_hour[i])
+        if begin_hour >= 0:
+            f.rain_begin_hour = begin_hour
+
+
+def recent(f, max_age=None):
+    # whether a cached forecast will do, when max_age is set it must have
+    # been fetched less than max_age seconds ago
+    if f is None:
+        return False
+    if max_age is None:
+        return True
+    return f.fetched_at is not None and time.time() - f.fetched_at < max_age
+
+
+def get_forecast(latitude, longitude, priority=shigurelimit.INTERACTIVE, max_age=None):
+    # max_age: seconds, fetch again when the cached forecast is older even
+    # though it is still valid
+    if latitude is None or longitude is None:
+        return Forecast(status=Forecast.BAD_REQUEST)
+
+    # forecasts are shared by every location in the same grid cell
+    key = shigurecache.location_key(latitude, longitude)
+    with shiguretrace.span('forecast.cache'):
+        f = cached_forecast(key)
+    if recent(f, max_age):
+        return f
+
+    if settings.CACHE_REVALIDATE and max_age is None:
+        # answer from the expired forecast right away and fetch a new one
+        # in the background
+        f = stale_forecast(key)
+        if f is not None:
+            shigurecache.forecast_revalidator.submit(
+                key, lambda: shigurecache.forecast_flight.do(key, lambda: fetch_forecast(key, priority)))
+            return f
+
+    # callers arriving while a fetch is running wait for its result
+    with shiguretrace.span('forecast.fetch'):
+        return shigurecache.forecast_flight.do(key, lambda: fetch_forecast(key, priority, max_age))
+
+
+def stored_forecast(key, stale=False):
+    # a forecast saved by another process or before a restart, None when
+    # there is none (or it expired, unless stale is set)
+    if shigurecache.forecast_store is None:
+        return None
+    record = shigurecache.forecast_store.get(key, stale)
+    if record is None:
+        return None
+    return Forecast.from_record(key, record)
+
+
+def cached_forecast(key, store=True):
+    # the cached forecast of a cell moved to the current hour, None on a miss.
+    # the forecast store is only read when store is set
+    f = shigurecache.forecast_cache.get(key)
+    if f is None:
+        return restored_forecast(key) if store else None
+    return _current(key, f)
+
+
+def restored_forecast(key):
+    # cached_forecast from the forecast store, after the memory cache missed
+    f = stored_forecast(key)
+    if f is None:
+        return None
+    shigurecache.forecast_cache.put(key, f)
+    return _current(key, f)
+
+
+def _current(key, f):
+    # f moved to the current hour
+    current = f.current()
+    if current is not f and current is not None:
+        # later lookups within the hour share this window and its replies
+        shigurecache.forecast_cache.put(key, current)
+    return current
+
+
+def fetch_forecast(key, priority=shigurelimit.INTERACTIVE, max_age=None):
+    # the previous leader may have filled the cache in the meantime
+    f = shigurecache.forecast_cache.peek(key)
+    if recent(f, max_age):
+        return f
+    f = Forecast()
+    f.get(key[0], key[1], priority=priority)
+    return keep_forecast(key, f)
+
+
+def keep_forecast(key, f):
+    # the forecast to answer with after fetching f
+    if f.status == Forecast.OK:
+        shigurecache.forecast_cache.put(key, f)
+        if shigurecache.forecast_store is not None:
+            shigurecache.forecast_store.put(key, f)
+        return f
+    # an older forecast beats an error reply
+    return stale_forecast(key) or f
+
+
+def stale_forecast(key, store=True):
+    # an expired forecast moved to the current hour, None without one
+    stale = shigurecache.forecast_cache.stale(key)
+    if stale is None and store:
+        stale = stored_forecast(key, stale=True)
+    if stale is None:
+        return None
+    return stale.current()
+
 
 class Responce:
 
@@ -168,6 +481,7 @@ class Responce:
     NOT_NEED_UMBRELLA = 4
     INTERNAL_ERROR = 5
     DETAIL = 6
+    SETTING = 7
 
     def __init__(self, message='',status=GREETING):
         self.message = message
@@ -176,119 +490,223 @@ class Responce:
     def __str__(self):
         return self.message
 
-def responce(message, latitude=None, longitude=None):
-    r = Responce()
-    if '傘いる' in message:
-        if latitude is None or longitude is None:
-            return Responce(
-                message='あなたの住んでいる場所を教えてください',
-                status=Responce.UNKOWN_LOCATION
-            )
-        else:
-            f = Forecast()
-            f.get(latitude, longitude)
-            
-            if (f.status != Forecast.OK):
-                print('Internal Error: {}'.format(f))
-                return Responce(
-                    message='すいません...\nなにか問題が発生していてお答えできません...',
-                    status=Responce.INTERNAL_ERROR
-                )
-            
-            s = ''
-            status = Responce.NEED_UMBRELLA
-            if f.rain_level == Forecast.RAIN_NEVER:
-                s = '今日は傘は必要ありません'
-                status = Responce.NOT_NEED_UMBRELLA
-            elif f.rain_level == Forecast.RAIN_HARDLY:
-                s = '今日はおそらく傘は必要ありません'
-                status = Responce.NOT_NEED_UMBRELLA
-            elif f.rain_level == Forecast.RAIN_MAYBE:
-                s = '{}時頃から雨が降る可能性があるので、傘が必要かもしれません。'.format(
-                    f.rain_begin_time.hour
-                )
-            elif f.rain_level == Forecast.RAIN_LIKELY:
-                s = '{}時頃から雨が降る可能性が高いので、傘が必要です。\n降水確率は最高で {}% です。'.format(
-                    f.rain_begin_time.hour,
-                    max(f.pop)
-                )
-            elif f.rain_level == Forecast.RAIN_ALMOST:
-                s = '{}時頃から雨がかなりの高確率で降るので、傘が必要です。\n降水確率は最高で {}% です。'.format(
-                    f.rain_begin_time.hour,
-                    max(f.pop)
-                )
-            
-            return Responce(
-                message=s,
-                status=status
-            )
-    elif '詳細' in message:
-        f = Forecast()
-        f.get(latitude, longitude)
-        
+class IntentRouter:
+    # picks the handler of the highest priority keyword in a message,
+    # scanning the message once
+
+    def __init__(self, default=None):
+        self.default = default
+        self._intents = {}
+        self._pattern = None
+
+    def register(self, keyword, handler, priority=None):
+        # earlier registrations win unless a priority is given
+        if priority is None:
+            priority = len(self._intents)
+        self._intents[keyword] = (priority, handler)
+        self._pattern = None
+
+    def intent(self, keyword, priority=None):
+        def decorator(handler):
+            self.register(keyword, handler, priority)
+            return handler
+        return decorator
+
+    def route(self, message):
+        pattern = self._pattern
+        if pattern is None:
+            keywords = sorted(self._intents, key=len, reverse=True)
+            pattern = self._pattern = re.compile('|'.join(map(re.escape, keywords)))
+        best = None
+        for match in pattern.finditer(message):
+            intent = self._intents[match.group()]
+            if best is None or intent[0] < best[0]:
+                best = intent
+        if best is None:
+            return self.default
+        return best[1]
+
+
+# reply templates
+ERROR_RESPONCE = Responce(
+    message='すいません...\nなにか問題が発生していてお答えできません...',
+    status=Responce.INTERNAL_ERROR
+)
+UNKOWN_LOCATION_RESPONCE = Responce(
+    message='あなたの住んでいる場所を教えてください',
+    status=Responce.UNKOWN_LOCATION
+)
+HELP_RESPONCE = Responce(
+    message='今、傘がいるかどうか知りたい場合「傘いる？」と聞いてください！\n\n'\
+    '天気予報の詳細が知りたい場合は「詳細」と聞いてくれればお教えします。\n' \
+    'また、特定の時刻で傘が必要な場合に通知させたい場合「通知 7:00」のように「通知」の後に通知を受け取りたい時刻を教えてください。\n'\
+    '雨が降りそうになった時にお知らせが欲しい場合は「雨アラート」と送ってください。\n'\
+    '位置情報を設定または設定し直したい場合、＋マークから位置情報を送信してください。',
+    status=Responce.HELP
+)
+GREETING_RESPONCE = Responce(
+    message='今日、傘がいるかどうか教えます！\n「傘いる？」と聞いてください。\n' \
+    '最初に使う時は、あなたの住んでいる場所を送ってください！\n' \
+    'また、特定の時間に傘がいるかどうか通知するよう設定することも可能です。\n' \
+    '詳細を知りたい場合は「ヘルプ」と入力してください。',
+    status=Responce.GREETING
+)
+
+# '傘いる': (message, status) by rain level
+UMBRELLA_TEMPLATES = {
+    Forecast.RAIN_NEVER: ('今日は傘は必要ありません', Responce.NOT_NEED_UMBRELLA),
+    Forecast.RAIN_HARDLY: ('今日はおそらく傘は必要ありません', Responce.NOT_NEED_UMBRELLA),
+    Forecast.RAIN_MAYBE: (
+        '{hour}時頃から雨が降る可能性があるので、傘が必要かもしれません。',
+        Responce.NEED_UMBRELLA),
+    Forecast.RAIN_LIKELY: (
+        '{hour}時頃から雨が降る可能性が高いので、傘が必要です。\n降水確率は最高で {max_pop}% です。',
+        Responce.NEED_UMBRELLA),
+    Forecast.RAIN_ALMOST: (
+        '{hour}時頃から雨がかなりの高確率で降るので、傘が必要です。\n降水確率は最高で {max_pop}% です。',
+        Responce.NEED_UMBRELLA),
+}
+
+# '詳細': headline by rain level
+DETAIL_TEMPLATES = {
+    Forecast.RAIN_NEVER: '今日は傘は必要ありません\n',
+    Forecast.RAIN_HARDLY: '今日はおそらく傘は必要ありません\n',
+    Forecast.RAIN_MAYBE: '{hour}時頃から雨が降る可能性があります。\n',
+    Forecast.RAIN_LIKELY: '{hour}時頃から雨が降る可能性が高いです。\n',
+    Forecast.RAIN_ALMOST: '{hour}時頃から雨が高確率で降ります。\n',
+}
+DETAIL_TABLE_HEADER = '\n【{}時間後までの降水確率】\n'.format(settings.FORECAST_LENGTH)
+DETAIL_TABLE_LINE = '{0:2d} 時: {1}%\n'
+DETAIL_MAX_POP = '\n最高降水確率: {}% ({} 時)\n'
+
+# replies to settings messages, answered by the webhook apps themselves
+SCHEDULE_TIME = re.compile('([0-9]?[0-9]):([0-9][0-9])')
+SCHEDULE_USAGE_MESSAGE = '通知設定をしたい場合は、「通知 8:00」のように設定時刻を送ってください。'
+SCHEDULE_SAVED_MESSAGE = '通知設定を保存しました。'
+SCHEDULE_FORMAT_MESSAGE = '半角で hh:mm のフォーマットで送信してください。'
+LOCATION_SAVED_MESSAGE = '位置情報を設定しました！'
+LOCATION_HINT = '\n+マークから「位置情報」を選択して位置情報を設定してください！'
+ALERT_ON_MESSAGE = '雨が降りそうになったらお知らせします。\nやめたい場合は「雨アラート解除」と送ってください。'
+ALERT_OFF_MESSAGE = '雨のお知らせをやめました。'
+
+router = IntentRouter(default=lambda message, latitude, longitude: GREETING_RESPONCE)
+
+
+def _format(template, f):
+    if f.rain_begin_hour is None:
+        return template
+    return template.format(hour=f.rain_begin_time.hour, max_pop=f.max_pop)
+
+
+def rendered(f, intent, render):
+    # replies depend only on the forecast, so they are cached on it and
+    # go away together with its forecast cache entry
+    r = f.replies.get(intent)
+    if r is None:
+        r = f.replies[intent] = render(f)
+    return r
+
+
+def render_umbrella(f):
+    template, status = UMBRELLA_TEMPLATES[f.rain_level]
+    return Responce(message=_format(template, f), status=status)
+
+
+def render_detail(f):
+    hour = f.time_start.hour
+    lines = [_format(DETAIL_TEMPLATES[f.rain_level], f), DETAIL_TABLE_HEADER]
+    for i in range(min(settings.FORECAST_LENGTH, len(f.pop))):
+        lines.append(DETAIL_TABLE_LINE.format((hour + i) % 24, f.pop[i]))
+    lines.append(DETAIL_MAX_POP.format(f.max_pop, (hour + f.max_pop_hour) % 24))
+    return Responce(message=''.join(lines), status=Responce.DETAIL)
+
+
+class ForecastIntent:
+    # an intent answered from the forecast of the user's location
+
+    def __init__(self, name, render, needs_location=True):
+        self.name = name
+        self.render = render
+        self.needs_location = needs_location
+
+    def __call__(self, message, latitude, longitude):
+        if self.needs_location and (latitude is None or longitude is None):
+            return UNKOWN_LOCATION_RESPONCE
+        return self.reply(get_forecast(latitude, longitude))
+
+    def reply(self, f):
         if (f.status != Forecast.OK):
-            return Responce(
-                message='すいません...\nなにか問題が発生していてお答えできません...',
-                status=Responce.INTERNAL_ERROR
-            )
-        
-        s = ''
-        time = f.time_start
-
-        if f.rain_level == Forecast.RAIN_NEVER:
-            s = '今日は傘は必要ありません\n'
-        elif f.rain_level == Forecast.RAIN_HARDLY:
-            s = '今日はおそらく傘は必要ありません\n'
-        elif f.rain_level == Forecast.RAIN_MAYBE:
-            s = '{}時頃から雨が降る可能性があります。\n'.format(
-                f.rain_begin_time.hour
-            )
-        elif f.rain_level == Forecast.RAIN_LIKELY:
-            s = '{}時頃から雨が降る可能性が高いです。\n'.format(
-                f.rain_begin_time.hour
-            )
-        elif f.rain_level == Forecast.RAIN_ALMOST:
-            s = '{}時頃から雨が高確率で降ります。\n'.format(
-                f.rain_begin_time.hour
-            )
+            logger.error('Internal Error: %s', f)
+            return ERROR_RESPONCE
+        with shiguretrace.span('render', intent=self.name):
+            return rendered(f, self.name, self.render)
+
+
+umbrella_responce = ForecastIntent('umbrella', render_umbrella)
+detail_responce = ForecastIntent('detail', render_detail, needs_location=False)
+router.register('傘いる', umbrella_responce)
+router.register('詳細', detail_responce)
+
+
+@router.intent('ヘルプ')
+def help_responce(message, latitude, longitude):
+    return HELP_RESPONCE
+
+
+def responce(message, latitude=None, longitude=None):
+    return router.route(message)(message, latitude, longitude)
+
+
+class SettingIntent:
+    # an intent changing the user's settings, saved by the webhook apps:
+    #
+    #     handler = router.route(text)
+    #     if isinstance(handler, SettingIntent):
+    #         reply, changes = handler.request(text)   # changes for store.update(), None if invalid
+
+    def __init__(self, name, request):
+        self.name = name
+        self.request = request
+
+    def __call__(self, message, latitude, longitude):
+        # the reply alone, for callers without a settings store
+        text, changes = self.request(message)
+        return Responce(message=text, status=Responce.SETTING)
+
+
+def schedule_request(message):
+    # reply to a '通知 7:00' message and the schedule to save, None if invalid
+    match = SCHEDULE_TIME.search(message)
+    if not match:
+        return SCHEDULE_USAGE_MESSAGE, None
+    hour = int(match.group(1))
+    minute = int(match.group(2))
+    if hour >= 0 and hour < 24 and minute >= 0 and minute <= 59:
+        return SCHEDULE_SAVED_MESSAGE, {'schedule_hour': hour, 'schedule_minute': minute}
+    return SCHEDULE_FORMAT_MESSAGE, None
+
+
+def alert_request(message):
+    # reply to a '雨アラート' message and whether the user wants rain alerts
+    if '解除' in message:
+        return ALERT_OFF_MESSAGE, {'rain_alert': False}
+    return ALERT_ON_MESSAGE, {'rain_alert': True}
+
+
+# settings messages win over questions in the same message, '雨アラート' first
+router.register('雨アラート', SettingIntent('alert', alert_request), priority=-2)
+router.register('通知', SettingIntent('schedule', schedule_request), priority=-1)
+
+
+def reply_text(r):
+    # text sent back to the user for a Responce
+    if r.staus == Responce.UNKOWN_LOCATION:
+        return r.message + LOCATION_HINT
+    return r.message
 
-        s += '\n【12時間後までの降水確率】\n'
-        for i in range(settings.FORECAST_LENGTH):
-            s += '{0:2d} 時: {1}%\n'.format(time.hour, f.pop[i])
-            time += dt.timedelta(hours=1)
-        max_pop_hour = 0
-        max_pop = 0
-        h = 0
-        for pop in f.pop:
-            if max_pop < pop:
-                max_pop = pop
-                max_pop_hour = h
-            h += 1
-        s += '\n最高降水確率: {}% ({} 時)\n'.format(
-            max_pop,
-            (f.rain_begin_time + dt.timedelta(hours=max_pop_hour)).hour)
-        return Responce(
-            message=s,
-            status=Responce.DETAIL
-        )
-    elif 'ヘルプ' in message:
-        return Responce(
-            message='今、傘がいるかどうか知りたい場合「傘いる？」と聞いてください！\n\n'\
-            '天気予報の詳細が知りたい場合は「詳細」と聞いてくれればお教えします。\n' \
-            'また、特定の時刻で傘が必要な場合に通知させたい場合「通知 7:00」のように「通知」の後に通知を受け取りたい時刻を教えてください。\n'\
-            '位置情報を設定または設定し直したい場合、＋マークから位置情報を送信してください。',
-            status=Responce.HELP
-        )
-    else:
-        return Responce(
-            message='今日、傘がいるかどうか教えます！\n「傘いる？」と聞いてください。\n' \
-            '最初に使う時は、あなたの住んでいる場所を送ってください！\n' \
-            'また、特定の時間に傘がいるかどうか通知するよう設定することも可能です。\n' \
-            '詳細を知りたい場合は「ヘルプ」と入力してください。',
-            status=Responce.GREETING
-            )
 
 if __name__ == '__main__':
+    shigurelog.configure()
     while True:
         r = responce(input('>> '),latitude=38.27, longitude=140.85)
         print(r)
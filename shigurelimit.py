@@ -0,0 +1,202 @@
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+import settings
+import shigurelog
+import shigurestats
+
+logger = shigurelog.get_logger('limit')
+
+# request priorities, most important first
+INTERACTIVE = 0
+NOTIFICATION = 1
+PREFETCH = 2
+PRIORITY_NAMES = ['interactive', 'notification', 'prefetch']
+
+
+class TokenBucket:
+    # holds up to capacity tokens, refilled at rate tokens per second
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time() if now is None else now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class QuotaLimiter:
+    # client side budget for an upstream quota. lower priorities give up while
+    # part of the budget is left, so replies to users still find some.
+    # the per minute rate halves whenever the upstream refuses a request
+    # anyway and grows back while requests succeed.
+    # with a path, the day's count and the bucket live in a SQLite database
+    # so every process on the host spends from the same budget; allowed,
+    # denied and throttled are counted per process.
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS budgets ('
+        ' name TEXT PRIMARY KEY,'
+        ' day INTEGER,'
+        ' used INTEGER,'
+        ' tokens REAL,'
+        ' rate REAL,'
+        ' updated REAL)',
+    )
+
+    def __init__(self,
+        minute_budget=settings.WEATHER_MINUTE_BUDGET,
+        daily_budget=settings.WEATHER_DAILY_BUDGET,
+        reserves=(0.0, settings.WEATHER_RESERVE_NOTIFICATION, settings.WEATHER_RESERVE_PREFETCH),
+        path=settings.WEATHER_BUDGET_DB_PATH,
+        name='weather'
+        ):
+        self.minute_budget = minute_budget
+        self.daily_budget = daily_budget
+        self.reserves = reserves
+        self.path = path
+        self.name = name
+        self.bucket = None
+        if minute_budget:
+            self.bucket = TokenBucket(minute_budget / 60, minute_budget)
+        self.day = None
+        self.used_today = 0
+        self.allowed = [0] * len(PRIORITY_NAMES)
+        self.denied = [0] * len(PRIORITY_NAMES)
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = None
+
+    def _connect(self):
+        # one connection per process, used under _lock. a process forked
+        # after importing this module opens its own
+        if self._db is None or self._pid != os.getpid():
+            db = sqlite3.connect(
+                self.path,
+                timeout=settings.WEATHER_BUDGET_DB_TIMEOUT,
+                isolation_level=None,
+                check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            for statement in QuotaLimiter.SCHEMA:
+                db.execute(statement)
+            self._db = db
+            self._pid = os.getpid()
+        return self._db
+
+    @contextlib.contextmanager
+    def _shared(self):
+        # loads the budget other processes left and saves what this one did
+        # with it, called with _lock held. when the database is locked longer
+        # than WEATHER_BUDGET_DB_TIMEOUT, the budget as last seen is used
+        if not self.path:
+            yield
+            return
+        try:
+            db = self._connect()
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute(
+                'SELECT day, used, tokens, rate, updated FROM budgets WHERE name = ?',
+                (self.name,)).fetchone()
+        except sqlite3.OperationalError as e:
+            logger.warning('weather budget lookup failed: %s', e)
+            self._rollback()
+            yield
+            return
+        if row is not None:
+            self.day, self.used_today = row[0], row[1]
+            if self.bucket is not None and row[2] is not None:
+                self.bucket.tokens, self.bucket.rate, self.bucket.updated = row[2:5]
+        try:
+            yield
+        except Exception:
+            self._rollback()
+            raise
+        bucket = self.bucket
+        try:
+            db.execute(
+                'INSERT OR REPLACE INTO budgets (name, day, used, tokens, rate, updated)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (self.name, self.day, self.used_today) + (
+                    (bucket.tokens, bucket.rate, bucket.updated) if bucket is not None else (None, None, None)))
+            db.execute('COMMIT')
+        except sqlite3.OperationalError as e:
+            logger.warning('failed to save the weather budget: %s', e)
+            self._rollback()
+
+    def _rollback(self):
+        if self._db is not None and self._db.in_transaction:
+            self._db.execute('ROLLBACK')
+
+    def acquire(self, priority=INTERACTIVE, now=None):
+        # takes one request from the budget, False when none is left for this priority
+        if now is None:
+            now = time.time()
+        reserve = self.reserves[priority]
+        with self._lock, self._shared():
+            day = int(now // 86400)
+            if day != self.day:
+                self.day = day
+                self.used_today = 0
+            allowed = not self.daily_budget or self.used_today < self.daily_budget * (1 - reserve)
+            if allowed and self.bucket is not None:
+                self.bucket.refill(now)
+                allowed = self.bucket.tokens - 1 >= self.bucket.capacity * reserve
+            if not allowed:
+                self.denied[priority] += 1
+                return False
+            if self.bucket is not None:
+                self.bucket.tokens -= 1
+            self.used_today += 1
+            self.allowed[priority] += 1
+            return True
+
+    def throttle(self, now=None):
+        # the upstream refused a request, its quota is tighter than our budget
+        if now is None:
+            now = time.time()
+        with self._lock, self._shared():
+            self.throttled += 1
+            if self.bucket is not None:
+                self.bucket.refill(now)
+                self.bucket.tokens = 0
+                self.bucket.rate = max(self.bucket.rate / 2, self.minute_budget / 60 / 16)
+
+    def recover(self):
+        if self.bucket is None:
+            return
+        with self._lock:
+            # the rate as of the last request, which is all most successes need
+            if self.bucket.rate >= self.minute_budget / 60:
+                return
+            with self._shared():
+                self.bucket.rate = min(self.minute_budget / 60, self.bucket.rate + self.minute_budget / 60 / 16)
+
+    def stats(self):
+        return {
+            'used_today': self.used_today,
+            'allowed': dict(zip(PRIORITY_NAMES, self.allowed)),
+            'denied': dict(zip(PRIORITY_NAMES, self.denied)),
+            'throttled': self.throttled,
+            'minute_rate': self.bucket.rate * 60 if self.bucket is not None else None,
+        }
+
+
+weather_limiter = QuotaLimiter()
+
+shigurestats.counter_callback(
+    'shigure_weather_budget_allowed_total', 'Weather requests allowed by the quota budget',
+    lambda: dict(zip(PRIORITY_NAMES, weather_limiter.allowed)), ('priority',))
+shigurestats.counter_callback(
+    'shigure_weather_budget_denied_total', 'Weather requests denied by the quota budget',
+    lambda: dict(zip(PRIORITY_NAMES, weather_limiter.denied)), ('priority',))
+shigurestats.gauge_callback(
+    'shigure_weather_budget_used_today', 'Weather requests spent today',
+    lambda: weather_limiter.used_today)
@@ -4,7 +4,7 @@ import os
 import sys
 from argparse import ArgumentParser
 
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort
 from linebot import (
     LineBotApi, WebhookParser
 )
@@ -15,143 +15,127 @@ from linebot.models import (
     MessageEvent, TextMessage, LocationMessage, TextSendMessage,
 )
 
+import settings
 import shigurecore
-import json
+import shigurelog
+import shigurenotify
+import shigurequeue
+import shigurestats
+import shigurestore
+import shiguretrace
 import atexit
-import re
 import threading
-import time
-import datetime as dt
 
-app = Flask(__name__)
+logger = shigurelog.get_logger('line')
 
-# get channel_secret and channel_access_token from your environment variable
-channel_secret = os.getenv('LINE_CHANNEL_SECRET', None)
-channel_access_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN', None)
-if channel_secret is None:
-    print('Specify LINE_CHANNEL_SECRET as environment variable.')
-    sys.exit(1)
-if channel_access_token is None:
-    print('Specify LINE_CHANNEL_ACCESS_TOKEN as environment variable.')
-    sys.exit(1)
+WEBHOOK_HANDLING = shigurestats.histogram(
+    'shigure_webhook_seconds', 'Time to answer a webhook request')
 
-line_bot_api = LineBotApi(channel_access_token)
-parser = WebhookParser(channel_secret)
+# set by create_app()
+line_bot_api = None
+parser = None
+# set by start()
+user_settings = None
+event_pool = None
+notifier_lock = None
+_started_pid = None
+_start_lock = threading.Lock()
 
-user_settings = {}
-
-@app.route("/callback", methods=['POST'])
 def callback():
-    signature = request.headers['X-Line-Signature']
+    start()
+    with WEBHOOK_HANDLING.time(), shiguretrace.trace('webhook'):
+        signature = request.headers['X-Line-Signature']
+
+        # get request body as text
+        body = request.get_data(as_text=True)
+        logger.debug('request body: %s', body)
+
+        # parse webhook body
+        try:
+            with shiguretrace.span('parse', bytes=len(body)):
+                events = parser.parse(body, signature)
+        except InvalidSignatureError:
+            abort(400)
+
+        for event in events:
+            if event_pool is not None and event_pool.submit(event):
+                continue
+            # handle inline when processing synchronously or the queue is full
+            handle_event(event)
 
-    # get request body as text
-    body = request.get_data(as_text=True)
-    app.logger.info("Request body: " + body)
+    return 'OK'
 
-    # parse webhook body
-    try:
-        events = parser.parse(body, signature)
-    except InvalidSignatureError:
-        abort(400)
-
-    # if event is MessageEvent and message is TextMessage, then echo text
-    for event in events:
-
-        ## recieved message event
-        if not isinstance(event, MessageEvent):
-            continue
-
-        user_id = event.source.user_id
-        message = event.message
-        print('recieved message from {}'.format(user_id))
-
-        ## recieved text message
-        if isinstance(message, TextMessage):
-            if '通知' in message.text:
-                match = re.search('([0-9]?[0-9]):([0-9][0-9])', message.text)
-                if not match:
-                    line_bot_api.reply_message(
-                        event.reply_token,
-                        TextSendMessage(text='通知設定をしたい場合は、「通知 8:00」のように設定時刻を送ってください。')
-                    )
-                else:
-                    hour = int(match.group(1))
-                    minute = int(match.group(2))
-                    if hour >= 0 and hour < 24 and minute >= 0 and minute <= 59:
-                        add_user_setting(user_id, schedule_hour=hour, schedule_minute=minute)
-                        line_bot_api.reply_message(
-                            event.reply_token,
-                            TextSendMessage(text='通知設定を保存しました。')
-                        )
-                    else:
-                        line_bot_api.reply_message(
-                            event.reply_token,
-                            TextSendMessage(text='半角で hh:mm のフォーマットで送信してください。')
-                        )
-            else:
-                latitude = None
-                longitude = None
-                if user_id in user_settings:
-                    latitude = user_settings[user_id]['latitude']
-                    longitude = user_settings[user_id]['longitude']
-                r = shigurecore.responce(message.text, latitude=latitude, longitude=longitude)
-                text = r.message
-                if r.staus == shigurecore.Responce.UNKOWN_LOCATION:
-                    text += '\n+マークから「位置情報」を選択して位置情報を設定してください！'
-
-                line_bot_api.reply_message(
-                    event.reply_token,
-                    TextSendMessage(text=text)
-                )
-
-        ## recieved location message
-        if isinstance(message, LocationMessage):
-            add_user_setting(user_id, latitude=message.latitude, longitude=message.longitude)
-
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text='位置情報を設定しました！')
-            )
+def metrics():
+    return Response(shigurestats.registry.render(), mimetype='text/plain; version=0.0.4')
 
-    return 'OK'
+def admin(name):
+    status, text = shiguretrace.admin(name, request.method, request.args, request.headers.get('Authorization'))
+    return Response(text, status=status, mimetype='text/plain')
+
+def reply(event, text):
+    with shiguretrace.span('reply'):
+        line_bot_api.reply_message(
+            event.reply_token,
+            TextSendMessage(text=text)
+        )
+
+@shiguretrace.traced('event')
+def handle_event(event):
+    ## recieved message event
+    if not isinstance(event, MessageEvent):
+        return
 
-def add_user_setting(user_id, latitude=None, longitude=None, schedule_hour=None, schedule_minute=None):
-    setting = {}
+    user_id = event.source.user_id
+    message = event.message
+    logger.info('recieved message from %s', user_id)
+
+    ## recieved text message
+    if isinstance(message, TextMessage):
+        handler = shigurecore.router.route(message.text)
+        if isinstance(handler, shigurecore.SettingIntent):
+            text, changes = handler.request(message.text)
+            if changes is not None:
+                add_user_setting(user_id, **changes)
+            reply(event, text)
+        else:
+            latitude = None
+            longitude = None
+            with shiguretrace.span('settings'):
+                setting = user_settings.get(user_id)
+            if setting is not None:
+                latitude = setting.get('latitude')
+                longitude = setting.get('longitude')
+            with shiguretrace.span('responce'):
+                r = handler(message.text, latitude, longitude)
+
+            reply(event, shigurecore.reply_text(r))
+
+    ## recieved location message
+    if isinstance(message, LocationMessage):
+        add_user_setting(user_id, latitude=message.latitude, longitude=message.longitude)
+
+        reply(event, shigurecore.LOCATION_SAVED_MESSAGE)
+
+def add_user_setting(user_id, latitude=None, longitude=None, schedule_hour=None, schedule_minute=None,
+    rain_alert=None):
     if not user_id:
         return
 
-    already_exists = user_id in user_settings
-    if already_exists:
-        setting = user_settings[user_id]
-    overwrite_latitude = False
-    overwrite_longitude = False
-    overwrite_schedule_hour = False
-    overwrite_schedule_minute = False
-
-    if latitude is not None:
-        if already_exists:
-            overwrite_latitude = 'latitude' in user_settings[user_id]
-        setting['latitude'] = latitude
-    
-    if longitude is not None:
-        if already_exists:
-            overwrite_longitude = 'longitude' in user_settings[user_id]
-        setting['longitude'] = longitude
-    
-    if schedule_hour is not None:
-        if already_exists:
-            overwrite_schedule_hour = 'schedule_hour' in user_settings[user_id]
-        setting['schedule_hour'] = schedule_hour
-    
-    if schedule_minute is not None:
-        if already_exists:
-            overwrite_schedule_minute = 'schedule_minute' in user_settings[user_id]
-        setting['schedule_minute'] = schedule_minute
-
-    user_settings[user_id] = setting
-
-    if already_exists:
-        print ('overwrited user setting [{}]: latitude: {}{} longitude: {}{} schedule: {}:{}{}'.format(
+    previous = user_settings.update(
+        user_id,
+        latitude=latitude,
+        longitude=longitude,
+        schedule_hour=schedule_hour,
+        schedule_minute=schedule_minute,
+        rain_alert=rain_alert)
+
+    if previous is not None:
+        overwrite_latitude = latitude is not None and 'latitude' in previous
+        overwrite_longitude = longitude is not None and 'longitude' in previous
+        overwrite_schedule_hour = schedule_hour is not None and 'schedule_hour' in previous
+        overwrite_rain_alert = rain_alert is not None and 'rain_alert' in previous
+        logger.info(
+            'overwrited user setting [%s]: latitude: %s%s longitude: %s%s schedule: %s:%s%s rain alert: %s%s',
             user_id,
             latitude,
             '(overwrite)' if overwrite_latitude else '',
@@ -159,72 +143,79 @@ def add_user_setting(user_id, latitude=None, longitude=None, schedule_hour=None,
             '(overwrite)' if overwrite_longitude else '',
             schedule_hour, schedule_minute,
             '(overwrite)' if overwrite_schedule_hour else '',
-        ))
+            rain_alert,
+            '(overwrite)' if overwrite_rain_alert else '',
+        )
     else:
-        print ('added user setting [{}]: latitude: {} longitude: {} schedule: {}:{}'.format(
+        logger.info(
+            'added user setting [%s]: latitude: %s longitude: %s schedule: %s:%s rain alert: %s',
             user_id,
             latitude,
             longitude,
             schedule_hour, schedule_minute,
-        ))
-
-def load_user_settings():
-    with open('usersettings.json') as f:
-        user_settings = json.load(f)
-    print('loaded user settings.')
-
-def save_user_settings():
-    with open('usersettings.json', 'w') as f:
-        json.dump(user_settings, f, indent=4)
-    print('saved user settings.')
-
-class JST(dt.tzinfo):
-    def utcoffset(self, dat):
-        return dt.timedelta(hours=9)
-
-    def dst(self, dat):
-        return dt.timedelta(0)
-
-    def tzname(self, dat):
-        return 'JST'
-
-
-class Notifier(threading.Thread):
-    def __init__(self):
-        super(Notifier, self).__init__()
-        self.minute = 0
-
-    def send_notification(self, user_id):
-        print('send notification to {}'.format(user_id))
-        setting = user_settings[user_id]
-        if setting['latitude'] is None or setting['longitude'] is None:
-            line_bot_api.push_message(user_id, TextSendMessage(text='通知の設定がされていますが、位置情報が設定されていません。＋マークから位置情報を設定してください。'))
-        
-        r = shigurecore.responce('傘いる？', latitude=setting['latitude'], longitude=setting['longitude'])
-        if r.staus == shigurecore.Responce.NEED_UMBRELLA:
-            line_bot_api.push_message(user_id, TextSendMessage(text='こんにちは\n' + r.message))
-        else:
-            print('canceled notification: status: {}'.format(r.staus))
-
-    def run(self):
-        print('start running notifier')
-        while True:
-            now = dt.datetime.now(JST())
-            hour = now.hour
-            minute = now.minute
-            print('check notification {0:2d}:{1:2d}'.format(hour, minute))
-            if self.minute != minute:
-                self.minute = minute
-                for user_id, v in user_settings.items():
-                    if 'schedule_hour' in v:
-                        if v['schedule_hour'] == hour and v['schedule_minute'] == minute:
-                            self.send_notification(user_id)
-            time.sleep(30)
-            
-
-load_user_settings()
-atexit.register(save_user_settings)
-Notifier().start()
+            rain_alert,
+        )
+
+def start():
+    # opens the settings store and starts the notifier and the event pool.
+    # called by each worker process when it boots (post_worker_init in
+    # gunicorn.conf.py), so a master importing the app (gunicorn --preload)
+    # forks workers without threads or databases. the first request calls it
+    # too, for servers without that hook
+    global user_settings, event_pool, notifier_lock, _started_pid
+    if _started_pid == os.getpid():
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        user_settings = shigurestore.open_store()
+        atexit.register(stop)
+        if settings.NOTIFIER_EMBEDDED:
+            # every worker starts one, the lock lets only one of them send notifications
+            notifier_lock = shigurenotify.NotifierLock()
+            shigurenotify.Notifier(line_bot_api, user_settings, notifier_lock).start()
+        if settings.WEBHOOK_ASYNC:
+            event_pool = shigurequeue.WorkerPool(handle_event).start()
+        _started_pid = os.getpid()
+        logger.info('started worker %s', _started_pid)
+
+def stop():
+    # closes what start() opened, the background threads end with the process
+    global user_settings, notifier_lock, _started_pid
+    with _start_lock:
+        if user_settings is None:
+            return
+        if event_pool is not None:
+            event_pool.queue.join()
+        if notifier_lock is not None:
+            notifier_lock.release()
+            notifier_lock = None
+        user_settings.close()
+        user_settings = None
+        _started_pid = None
+
+def create_app(channel_secret=None, channel_access_token=None):
+    # the Flask app, see Procfile. nothing is started until the worker
+    # calls start()
+    global line_bot_api, parser
+    shigurelog.configure()
+
+    # get channel_secret and channel_access_token from your environment variable
+    channel_secret = channel_secret or os.getenv('LINE_CHANNEL_SECRET', None)
+    channel_access_token = channel_access_token or os.getenv('LINE_CHANNEL_ACCESS_TOKEN', None)
+    if channel_secret is None:
+        raise RuntimeError('Specify LINE_CHANNEL_SECRET as environment variable.')
+    if channel_access_token is None:
+        raise RuntimeError('Specify LINE_CHANNEL_ACCESS_TOKEN as environment variable.')
+
+    line_bot_api = LineBotApi(channel_access_token, endpoint=settings.LINE_API_ENDPOINT, timeout=settings.LINE_TIMEOUT)
+    parser = WebhookParser(channel_secret)
+
+    app = Flask(__name__)
+    app.add_url_rule('/callback', 'callback', callback, methods=['POST'])
+    app.add_url_rule('/metrics', 'metrics', metrics)
+    app.add_url_rule('/admin/<name>', 'admin', admin, methods=['GET', 'POST'])
+    return app
 
 if __name__ == "__main__":
     arg_parser = ArgumentParser(
@@ -234,5 +225,10 @@ if __name__ == "__main__":
     arg_parser.add_argument('-d', '--debug', default=False, help='debug')
     options = arg_parser.parse_args()
 
-
-    app.run(debug=options.debug, port=options.port)
\ No newline at end of file
+    try:
+        app = create_app()
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+    start()
+    app.run(debug=options.debug, port=options.port, threaded=True)
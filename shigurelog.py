@@ -0,0 +1,39 @@
+import json
+import logging
+import sys
+
+import settings
+
+
+class JsonFormatter(logging.Formatter):
+    # one json object per line for log collectors
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def get_logger(name):
+    return logging.getLogger('shigure.' + name)
+
+
+def configure(level=settings.LOG_LEVEL, format=settings.LOG_FORMAT, stream=None):
+    # 'plain' prints bare messages to stdout like before, 'json' writes structured lines
+    logger = logging.getLogger('shigure')
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+    if format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
@@ -0,0 +1,558 @@
+"""Notification scheduler.
+
+Usually started inside the web workers (NOTIFIER_EMBEDDED=1). To run it as
+its own process instead, set NOTIFIER_EMBEDDED=0 for the web tier and run
+
+    python shigurenotify.py
+
+Either way a lock file makes sure only one notifier on the host is active.
+"""
+
+import datetime as dt
+import fcntl
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+
+import settings
+import shigurecache
+import shigurecore
+import shigurelimit
+import shigurelog
+import shigurestats
+import shigurestore
+from shigurestore import ScheduleIndex
+from shigurestats import percentile
+
+logger = shigurelog.get_logger('notify')
+
+PUSH_SEND = shigurestats.histogram(
+    'shigure_push_send_seconds', 'LINE push and multicast latency', ('method',))
+NOTIFIER_TICK = shigurestats.histogram(
+    'shigure_notifier_tick_seconds', 'Time to handle the users due in a minute')
+
+NOTIFICATION_GREETING = 'こんにちは\n'
+ALERT_GREETING = '雨が近づいています！\n'
+LOCATION_MISSING = '通知の設定がされていますが、位置情報が設定されていません。＋マークから位置情報を設定してください。'
+
+
+def group_users(users):
+    # users: iterable of (user_id, setting)
+    # returns user ids by location cell and the user ids without a location
+    cells = {}
+    no_location = []
+    for user_id, setting in users:
+        latitude = setting.get('latitude')
+        longitude = setting.get('longitude')
+        if latitude is None or longitude is None:
+            no_location.append(user_id)
+            continue
+        key = shigurecache.location_key(latitude, longitude)
+        cells.setdefault(key, []).append(user_id)
+    return cells, no_location
+
+
+def group_messages(replies, no_location):
+    # replies: [(Responce, user ids)] of every cell
+    # returns user ids by notification text, users with the same text share
+    # a multicast, and the number of users not notified because of no rain
+    messages = {}
+    if no_location:
+        messages[LOCATION_MISSING] = no_location
+    canceled = 0
+    for r, user_ids in replies:
+        if r.staus == shigurecore.Responce.NEED_UMBRELLA:
+            messages.setdefault(NOTIFICATION_GREETING + r.message, []).extend(user_ids)
+        else:
+            canceled += len(user_ids)
+    return messages, canceled
+
+
+def chunks(user_ids, limit):
+    for i in range(0, len(user_ids), limit):
+        yield user_ids[i:i + limit]
+
+
+def summary(scheduled_at, start, cells, no_location, warm, api_calls, lags, canceled, failed):
+    # the record of a notification wave kept as last_run
+    return {
+        'scheduled_at': scheduled_at,
+        'users': len(no_location) + sum(len(u) for u in cells.values()),
+        'cells': len(cells),
+        'warm_cells': warm,
+        'warm_ratio': warm / len(cells) if cells else 0.0,
+        'api_calls': api_calls,
+        'delivered': len(lags),
+        'canceled': canceled,
+        'failed': failed,
+        'duration': time.time() - start,
+        'lag_p50': percentile(lags, 50),
+        'lag_p95': percentile(lags, 95),
+        'lag_max': max(lags) if lags else 0.0,
+    }
+
+
+class Wave:
+    # one notification wave without its I/O, shared by Dispatcher and
+    # shigureasync.AsyncDispatcher: the cells to render, then the messages
+    # to send, then the summary
+
+    def __init__(self, users, scheduled_at, multicast_limit):
+        self.start = time.time()
+        self.scheduled_at = scheduled_at
+        self.multicast_limit = multicast_limit
+        self.cells, self.no_location = group_users(users)
+        # cells the prefetcher already warmed up
+        self.warm = sum(1 for key in self.cells if shigurecache.forecast_cache.peek(key) is not None)
+        # (user ids, text) of every push or multicast, set by rendered()
+        self.sends = []
+        self.canceled = 0
+
+    def rendered(self, replies):
+        # replies: the Responce of every cell, in the order of cells
+        messages, self.canceled = group_messages(zip(replies, self.cells.values()), self.no_location)
+        self.sends = [
+            (chunk, text)
+            for text, user_ids in messages.items()
+            for chunk in chunks(user_ids, self.multicast_limit)]
+
+    def summary(self, delivered):
+        # delivered: the time every send was delivered, None when it failed
+        lags = []
+        failed = 0
+        for (chunk, text), delivered_at in zip(self.sends, delivered):
+            if delivered_at is None:
+                failed += len(chunk)
+            else:
+                lags.extend([delivered_at - self.scheduled_at] * len(chunk))
+        return summary(
+            self.scheduled_at, self.start, self.cells, self.no_location, self.warm,
+            len(self.sends), lags, self.canceled, failed)
+
+
+class Dispatcher:
+    # sends one notification wave: one forecast per location cell,
+    # one multicast per distinct message
+
+    def __init__(self, line_bot_api,
+        workers=settings.NOTIFY_WORKERS,
+        multicast_limit=settings.LINE_MULTICAST_LIMIT
+        ):
+        self.line_bot_api = line_bot_api
+        self.multicast_limit = multicast_limit
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.last_run = None
+
+    def render(self, key):
+        f = shigurecore.get_forecast(key[0], key[1], priority=shigurelimit.NOTIFICATION)
+        return shigurecore.umbrella_responce.reply(f)
+
+    def send(self, user_ids, text):
+        message = TextSendMessage(text=text)
+        method = 'push' if len(user_ids) == 1 else 'multicast'
+        try:
+            with PUSH_SEND.time(method=method):
+                if method == 'push':
+                    self.line_bot_api.push_message(user_ids[0], message)
+                else:
+                    self.line_bot_api.multicast(user_ids, message)
+        except LineBotApiError as e:
+            logger.error('failed to send notification to %d users: %s', len(user_ids), e)
+            return None
+        except Exception as e:
+            # network errors surface as requests exceptions from line-bot-sdk
+            logger.error('failed to reach LINE for %d users: %s', len(user_ids), e)
+            return None
+        return time.time()
+
+    def dispatch(self, users, scheduled_at):
+        # users: iterable of (user_id, setting), scheduled_at: unix time
+        wave = Wave(users, scheduled_at, self.multicast_limit)
+        # one forecast per cell
+        wave.rendered(list(self.pool.map(self.render, wave.cells)))
+        sends = [self.pool.submit(self.send, chunk, text) for chunk, text in wave.sends]
+        self.last_run = wave.summary([future.result() for future in sends])
+        logger.info('notification dispatch: %s', self.last_run)
+        return self.last_run
+
+
+class JST(dt.tzinfo):
+    def utcoffset(self, dat):
+        return dt.timedelta(hours=9)
+
+    def dst(self, dat):
+        return dt.timedelta(0)
+
+    def tzname(self, dat):
+        return 'JST'
+
+
+def seconds_until(now, slot, next_slot):
+    # seconds from now (within slot) until next_slot starts, None without a next slot
+    if next_slot is None:
+        return None
+    minutes = (next_slot - slot) % ScheduleIndex.MINUTES_PER_DAY
+    if minutes == 0:
+        minutes = ScheduleIndex.MINUTES_PER_DAY
+    return minutes * 60 - now.second - now.microsecond / 1000000
+
+
+ONE_MINUTE = dt.timedelta(minutes=1)
+ONE_DAY = dt.timedelta(days=1)
+
+
+def minute_of(now):
+    return now.replace(second=0, microsecond=0)
+
+
+def slot_of(minute):
+    return minute.hour * 60 + minute.minute
+
+
+def pending_minutes(user_settings, last, until, limit=settings.NOTIFY_CATCH_UP_MINUTES):
+    # start times of the occupied slots after the minute last up to the
+    # minute until, oldest first. the schedulers handle every one of them, so
+    # a minute passing while they were busy or woke up late is sent late
+    # rather than never. see settled() for slots saved after their minute
+    minutes = []
+    minute = max(last, until - ONE_DAY) + ONE_MINUTE
+    while minute <= until:
+        slot = slot_of(minute)
+        next_slot = user_settings.next_slot(slot)
+        if next_slot is None:
+            break
+        minute += dt.timedelta(minutes=(next_slot - slot) % ScheduleIndex.MINUTES_PER_DAY)
+        if minute <= until:
+            minutes.append(minute)
+        minute += ONE_MINUTE
+    earliest = until - dt.timedelta(minutes=limit)
+    if minutes and minutes[0] < earliest:
+        skipped = [m for m in minutes if m < earliest]
+        logger.warning('skipped %d slots missed by more than %d minutes, from %s to %s',
+            len(skipped), limit, skipped[0], skipped[-1])
+        minutes = minutes[len(skipped):]
+    return minutes
+
+
+def settled(last, now, planned=None):
+    # the last minute a scheduler counts as handled when it finds nothing due
+    # at now, or wakes up at now because the schedule changed. slots saved
+    # for a minute that already passed are never sent, but the current minute
+    # and the one it was sleeping until (planned) still are
+    minute = minute_of(now)
+    if planned is not None:
+        minute = min(minute, minute_of(planned))
+    return max(last, minute - ONE_MINUTE)
+
+
+class NotifierLock:
+    # exclusive lock on a file, released by the OS when the process dies
+
+    def __init__(self, path=settings.NOTIFIER_LOCK_PATH):
+        self.path = path
+        self._file = None
+
+    def acquire(self, blocking=True):
+        f = open(self.path, 'a+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def claim(self, key):
+        # remembers the last handled slot in the lock file, so a notifier
+        # taking over in the middle of a minute doesn't send it twice
+        self._file.seek(0)
+        if self._file.read() == key:
+            return False
+        self._file.truncate(0)
+        self._file.write(key)
+        self._file.flush()
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def claim(lock, minute):
+    # whether this notifier sends the minute, see NotifierLock.claim
+    if lock is None:
+        return True
+    return lock.claim('{} {}'.format(minute.date(), slot_of(minute)))
+
+
+class Notifier(threading.Thread):
+    def __init__(self, line_bot_api, user_settings, lock=None):
+        super(Notifier, self).__init__()
+        self.daemon = True
+        # start of the last minute handled
+        self.last = None
+        self.user_settings = user_settings
+        self.lock = lock
+        self.dispatcher = Dispatcher(line_bot_api)
+
+    def run(self):
+        if self.lock is not None and not self.lock.acquire(blocking=False):
+            # stand by until the active notifier goes away
+            logger.info('another notifier is running, standing by')
+            self.lock.acquire()
+        logger.info('start running notifier')
+        try:
+            if settings.PREFETCH_ENABLED:
+                Prefetcher(self.user_settings).start()
+            if settings.ALERT_ENABLED:
+                RainWatcher(self.user_settings, self.dispatcher).start()
+            self.loop()
+        finally:
+            # let a standby notifier take over if this one ever stops
+            if self.lock is not None:
+                self.lock.release()
+
+    def tick(self, minute):
+        with NOTIFIER_TICK.time():
+            due = self.user_settings.due(slot_of(minute))
+            if due and claim(self.lock, minute):
+                self.dispatcher.dispatch(due, minute.timestamp())
+
+    def loop(self):
+        user_settings = self.user_settings
+        self.last = minute_of(dt.datetime.now(JST())) - ONE_MINUTE
+        while True:
+            version = user_settings.version
+            now = dt.datetime.now(JST())
+            timeout = settings.SETTINGS_POLL_INTERVAL
+            try:
+                minutes = pending_minutes(user_settings, self.last, minute_of(now))
+                if minutes:
+                    for minute in minutes:
+                        self.last = minute
+                        try:
+                            self.tick(minute)
+                        except Exception:
+                            # a failed minute must not stop the notifier holding the lock
+                            logger.exception('notification for %s failed', minute)
+                    # the clock moved on while sending, look again before sleeping
+                    continue
+                self.last = settled(self.last, now)
+                # sleep until the next minute someone wants a notification,
+                # or until the schedule changes
+                slot = slot_of(now)
+                timeout = seconds_until(now, slot, user_settings.next_slot(slot + 1))
+            except Exception:
+                logger.exception('notifier failed to read the schedule')
+            if user_settings.wait(version, timeout):
+                planned = None if timeout is None else now + dt.timedelta(seconds=timeout)
+                self.last = settled(self.last, dt.datetime.now(JST()), planned)
+
+
+def budget_spent(f):
+    # whether a prefetcher stops at the forecast f
+    if f.status == shigurecore.Forecast.API_LIMIT_EXCEEDED:
+        # the rest of the budget is kept for replies and notifications
+        logger.warning('prefetch stopped, weather API budget is spent')
+        return True
+    return False
+
+
+def prefetch_summary(slot, cells, fetched):
+    run = {
+        'slot': slot,
+        'cells': len(cells),
+        'fetched': fetched,
+    }
+    logger.info('prefetched forecasts: %s', run)
+    return run
+
+
+class Prefetcher(threading.Thread):
+    # warms the forecast cache for the cells of users due a few minutes later
+
+    def __init__(self, user_settings,
+        lead=settings.PREFETCH_LEAD_MINUTES,
+        rate=settings.PREFETCH_RATE
+        ):
+        super(Prefetcher, self).__init__()
+        self.daemon = True
+        self.user_settings = user_settings
+        self.lead = lead
+        self.interval = 1 / rate
+        # start of the last minute prefetched
+        self.last = None
+        self.prefetched = 0
+        self.last_run = None
+
+    def prefetch(self, slot):
+        cells, _ = group_users(self.user_settings.due(slot))
+        fetched = 0
+        for key in cells:
+            if shigurecache.forecast_cache.peek(key) is not None:
+                continue
+            f = shigurecore.get_forecast(key[0], key[1], priority=shigurelimit.PREFETCH)
+            if budget_spent(f):
+                break
+            fetched += 1
+            # stay well under the API quota
+            time.sleep(self.interval)
+        if cells:
+            self.prefetched += fetched
+            self.last_run = prefetch_summary(slot, cells, fetched)
+
+    def run(self):
+        logger.info('start running prefetcher')
+        user_settings = self.user_settings
+        lead = dt.timedelta(minutes=self.lead)
+        self.last = minute_of(dt.datetime.now(JST())) + lead - ONE_MINUTE
+        while True:
+            version = user_settings.version
+            now = dt.datetime.now(JST()) + lead
+            timeout = settings.SETTINGS_POLL_INTERVAL
+            try:
+                minutes = pending_minutes(user_settings, self.last, minute_of(now))
+                if minutes:
+                    for minute in minutes:
+                        self.last = minute
+                        self.prefetch(slot_of(minute))
+                    continue
+                self.last = settled(self.last, now)
+                slot = slot_of(now)
+                timeout = seconds_until(now, slot, user_settings.next_slot(slot + 1))
+            except Exception:
+                logger.exception('prefetch failed')
+            if user_settings.wait(version, timeout):
+                planned = None if timeout is None else now + dt.timedelta(seconds=timeout)
+                self.last = settled(self.last, dt.datetime.now(JST()) + lead, planned)
+
+
+class RainAlerts:
+    # remembers the rain outlook of each watched cell and tells which cells
+    # got worse since the previous check
+
+    def __init__(self,
+        level=settings.ALERT_RAIN_LEVEL,
+        earlier=dt.timedelta(hours=settings.ALERT_EARLIER_HOURS)
+        ):
+        self.level = level
+        self.earlier = earlier
+        # cell -> (rain level, rain begin time)
+        self.outlooks = {}
+
+    def changed(self, key, f):
+        # a cell seen for the first time only sets the baseline, so a restart
+        # doesn't alert everyone again
+        previous = self.outlooks.get(key)
+        self.outlooks[key] = (f.rain_level, f.rain_begin_time)
+        if previous is None or f.rain_level < self.level:
+            return False
+        if previous[0] < self.level:
+            return True
+        return (previous[1] is not None and f.rain_begin_time is not None
+            and previous[1] - f.rain_begin_time >= self.earlier)
+
+    def keep(self, cells):
+        # forget cells nobody subscribes to anymore
+        for key in set(self.outlooks) - set(cells):
+            del self.outlooks[key]
+
+    def check(self, cells, forecasts):
+        # (cell, forecast) of the cells that got worse, forecasts are in the order of cells
+        changed = [
+            (key, f) for key, f in zip(cells, forecasts)
+            if f.status == shigurecore.Forecast.OK and self.changed(key, f)]
+        self.keep(cells)
+        return changed
+
+
+def alert_text(f):
+    return ALERT_GREETING + shigurecore.umbrella_responce.reply(f).message
+
+
+def alert_summary(start, cells, changed, sends, delivered):
+    # sends: (user ids, text) of every push or multicast, delivered: the time
+    # each was delivered, None when it failed
+    run = {
+        'cells': len(cells),
+        'changed': len(changed),
+        'api_calls': len(sends),
+        'delivered': sum(len(chunk) for (chunk, text), at in zip(sends, delivered) if at is not None),
+        'duration': time.time() - start,
+    }
+    if changed:
+        logger.info('rain alerts: %s', run)
+    return run
+
+
+class RainWatcher(threading.Thread):
+    # checks the forecast of every cell with rain alert subscribers and
+    # pushes to the users of the cells whose outlook got worse
+
+    def __init__(self, user_settings, dispatcher,
+        interval=settings.ALERT_INTERVAL_MINUTES * 60
+        ):
+        super(RainWatcher, self).__init__()
+        self.daemon = True
+        self.user_settings = user_settings
+        self.dispatcher = dispatcher
+        self.interval = interval
+        self.alerts = RainAlerts()
+        self.last_run = None
+
+    def forecast(self, key):
+        # a forecast cached for hours would hide the changes alerts are about
+        return shigurecore.get_forecast(key[0], key[1], priority=shigurelimit.NOTIFICATION, max_age=self.interval)
+
+    def check(self):
+        start = time.time()
+        cells = list(self.user_settings.alert_cells())
+        changed = self.alerts.check(cells, self.dispatcher.pool.map(self.forecast, cells))
+
+        # only the users of changed cells are looked up
+        sends = [
+            (chunk, alert_text(f))
+            for key, f in changed
+            for chunk in chunks(self.user_settings.alert_users(key), self.dispatcher.multicast_limit)]
+        futures = [self.dispatcher.pool.submit(self.dispatcher.send, chunk, text) for chunk, text in sends]
+        self.last_run = alert_summary(start, cells, changed, sends, [future.result() for future in futures])
+        return self.last_run
+
+    def run(self):
+        logger.info('start running rain watcher')
+        while True:
+            hour = dt.datetime.now(JST()).hour
+            if settings.ALERT_START_HOUR <= hour < settings.ALERT_END_HOUR:
+                try:
+                    self.check()
+                except Exception:
+                    logger.exception('rain alert check failed')
+            time.sleep(self.interval)
+
+
+def main():
+    shigurelog.configure()
+    channel_access_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN', None)
+    if channel_access_token is None:
+        print('Specify LINE_CHANNEL_ACCESS_TOKEN as environment variable.')
+        sys.exit(1)
+
+    user_settings = shigurestore.open_store()
+    line_bot_api = LineBotApi(channel_access_token, endpoint=settings.LINE_API_ENDPOINT, timeout=settings.LINE_TIMEOUT)
+    notifier = Notifier(line_bot_api, user_settings, NotifierLock())
+    try:
+        notifier.run()
+    finally:
+        user_settings.close()
+
+
+if __name__ == '__main__':
+    main()
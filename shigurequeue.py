@@ -0,0 +1,101 @@
+import collections
+import queue
+import threading
+import time
+
+import settings
+import shigurelog
+import shigurestats
+from shigurestats import percentile
+
+logger = shigurelog.get_logger('queue')
+
+QUEUE_WAIT = shigurestats.histogram(
+    'shigure_queue_wait_seconds', 'Time items spend in the queue', ('pool',))
+QUEUE_PROCESSING = shigurestats.histogram(
+    'shigure_queue_processing_seconds', 'Time spent handling an item', ('pool',))
+
+
+class WorkerPool:
+    # processes queued items on background threads
+
+    def __init__(self, handler,
+        workers=settings.WEBHOOK_WORKERS,
+        max_queue=settings.WEBHOOK_QUEUE_SIZE,
+        name='webhook'
+        ):
+        self.handler = handler
+        self.workers = workers
+        self.name = name
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.busy = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        # (seconds spent waiting in the queue, seconds spent processing)
+        self.latencies = collections.deque(maxlen=1000)
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name='{}-{}'.format(self.name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        shigurestats.gauge_callback(
+            'shigure_queue_depth', 'Items waiting in the queue',
+            lambda: {self.name: self.queue.qsize()}, ('pool',))
+        shigurestats.gauge_callback(
+            'shigure_queue_busy_workers', 'Workers handling an item',
+            lambda: {self.name: self.busy}, ('pool',))
+        return self
+
+    def submit(self, item):
+        # returns False when the queue is full
+        try:
+            self.queue.put_nowait((item, time.time()))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            item, enqueued_at = self.queue.get()
+            started_at = time.time()
+            with self._lock:
+                self.busy += 1
+            try:
+                self.handler(item)
+            except Exception as e:
+                logger.exception('%s worker failed: %s', self.name, e)
+                with self._lock:
+                    self.failed += 1
+            finally:
+                finished_at = time.time()
+                with self._lock:
+                    self.busy -= 1
+                    self.processed += 1
+                    self.latencies.append((started_at - enqueued_at, finished_at - started_at))
+                QUEUE_WAIT.observe(started_at - enqueued_at, pool=self.name)
+                QUEUE_PROCESSING.observe(finished_at - started_at, pool=self.name)
+                self.queue.task_done()
+
+    def stats(self):
+        with self._lock:
+            waits = [w for w, _ in self.latencies]
+            runs = [r for _, r in self.latencies]
+            return {
+                'queue_depth': self.queue.qsize(),
+                'busy_workers': self.busy,
+                'workers': self.workers,
+                'processed': self.processed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'wait_p50': percentile(waits, 50),
+                'wait_p95': percentile(waits, 95),
+                'processing_p50': percentile(runs, 50),
+                'processing_p95': percentile(runs, 95),
+            }
@@ -0,0 +1,182 @@
+import threading
+import time
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(n, v) for n, v in zip(names, values)) + '}'
+
+
+class Metric:
+    # base class of metrics rendered in the Prometheus text format
+
+    TYPE = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def header(self):
+        return ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.TYPE)]
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append('{}{} {}'.format(self.name, _labels(self.labelnames, key), value))
+        return lines
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class GaugeCallback(Metric):
+    # value read when scraped, fn returns a number or {label values: number}
+    TYPE = 'gauge'
+
+    def __init__(self, name, help, fn, labelnames=()):
+        super(GaugeCallback, self).__init__(name, help, labelnames)
+        self.fn = fn
+
+    def render(self):
+        lines = self.header()
+        value = self.fn()
+        if value is None:
+            return []
+        if not isinstance(value, dict):
+            value = {(): value}
+        for key, v in sorted(value.items()):
+            if not isinstance(key, tuple):
+                key = (key,)
+            lines.append('{}{} {}'.format(self.name, _labels(self.labelnames, key), v))
+        return lines
+
+
+class CounterCallback(GaugeCallback):
+    # a counter kept elsewhere, e.g. the hits of the forecast cache
+    TYPE = 'counter'
+
+
+class _Timer:
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+    # seconds
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # per bucket counts, sum, count
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, c in zip(self.buckets, counts):
+                    cumulative += c
+                    lines.append('{}_bucket{} {}'.format(
+                        self.name, _labels(self.labelnames + ('le',), key + (bound,)), cumulative))
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _labels(self.labelnames + ('le',), key + ('+Inf',)), count))
+                lines.append('{}_sum{} {}'.format(self.name, _labels(self.labelnames, key), total))
+                lines.append('{}_count{} {}'.format(self.name, _labels(self.labelnames, key), count))
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            # modules may be imported more than once (e.g. as __main__)
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def counter(name, help, labelnames=()):
+    return registry.register(Counter(name, help, labelnames))
+
+
+def gauge(name, help, labelnames=()):
+    return registry.register(Gauge(name, help, labelnames))
+
+
+def gauge_callback(name, help, fn, labelnames=()):
+    return registry.register(GaugeCallback(name, help, fn, labelnames))
+
+
+def counter_callback(name, help, fn, labelnames=()):
+    return registry.register(CounterCallback(name, help, fn, labelnames))
+
+
+def histogram(name, help, labelnames=(), buckets=Histogram.BUCKETS):
+    return registry.register(Histogram(name, help, labelnames, buckets))
@@ -0,0 +1,471 @@
+import bisect
+import json
+import os
+import sqlite3
+import threading
+
+import settings
+import shigurecache
+import shigurelog
+
+logger = shigurelog.get_logger('store')
+
+FIELDS = ('latitude', 'longitude', 'schedule_hour', 'schedule_minute', 'rain_alert')
+
+
+def schedule_slot(setting):
+    # minute of day of a setting's notification, None without one
+    if setting is None or 'schedule_hour' not in setting or 'schedule_minute' not in setting:
+        return None
+    return setting['schedule_hour'] * 60 + setting['schedule_minute']
+
+
+def alert_cell(setting):
+    # forecast cell a user wants rain alerts for, None if not subscribed
+    if setting is None or not setting.get('rain_alert') or 'latitude' not in setting or 'longitude' not in setting:
+        return None
+    return shigurecache.location_key(setting['latitude'], setting['longitude'])
+
+
+class BucketIndex:
+    # user ids grouped by a key
+    # never modified, moved() returns a new index sharing the unchanged buckets
+
+    def __init__(self, buckets=None):
+        # key -> frozenset of user ids
+        self._buckets = buckets or {}
+
+    def __len__(self):
+        return sum(len(users) for users in self._buckets.values())
+
+    def get(self, key):
+        return self._buckets.get(key, frozenset())
+
+    def keys(self):
+        return list(self._buckets)
+
+    def moved(self, moves):
+        # moves: [(user_id, previous key, new key)], None for no key
+        changed = {}
+        for user_id, previous, key in moves:
+            if previous == key:
+                continue
+            for k in (previous, key):
+                if k is not None and k not in changed:
+                    changed[k] = set(self._buckets.get(k, ()))
+            if previous is not None:
+                changed[previous].discard(user_id)
+            if key is not None:
+                changed[key].add(user_id)
+        if not changed:
+            return self
+        buckets = dict(self._buckets)
+        for k, users in changed.items():
+            if users:
+                buckets[k] = frozenset(users)
+            else:
+                buckets.pop(k, None)
+        return self._copy(buckets, changed)
+
+    def _copy(self, buckets, changed):
+        return type(self)(buckets)
+
+
+class ScheduleIndex(BucketIndex):
+    # user ids bucketed by minute of day (0 - 1439)
+
+    MINUTES_PER_DAY = 24 * 60
+
+    def __init__(self, slots=None, occupied=None):
+        super(ScheduleIndex, self).__init__(slots)
+        self._occupied = occupied if occupied is not None else sorted(self._buckets)
+
+    def _copy(self, slots, changed):
+        occupied = self._occupied
+        if len(slots) != len(self._buckets) or any(s not in self._buckets for s in changed if s in slots):
+            # a slot became empty or occupied
+            occupied = None
+        return ScheduleIndex(slots, occupied)
+
+    def due(self, slot):
+        return self.get(slot)
+
+    def next_slot(self, slot):
+        # first occupied slot at or after the given one, wrapping at midnight
+        if not self._occupied:
+            return None
+        i = bisect.bisect_left(self._occupied, slot % ScheduleIndex.MINUTES_PER_DAY)
+        if i == len(self._occupied):
+            return self._occupied[0]
+        return self._occupied[i]
+
+
+class SettingsSnapshot:
+    # every user setting at one version
+    # published snapshots are never modified, so readers need no lock and
+    # writers only copy the shard they change
+
+    SHARDS = 64
+
+    __slots__ = ('version', 'schedule', 'alerts', '_shards')
+
+    def __init__(self, version=0, shards=None, schedule=None, alerts=None):
+        self.version = version
+        self.schedule = schedule or ScheduleIndex()
+        # subscribers of rain alerts by forecast cell
+        self.alerts = alerts or BucketIndex()
+        self._shards = shards or ({},) * SettingsSnapshot.SHARDS
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def get(self, user_id):
+        # the returned setting is shared, don't modify it
+        return self._shards[hash(user_id) % SettingsSnapshot.SHARDS].get(user_id)
+
+    def items(self):
+        for shard in self._shards:
+            for item in shard.items():
+                yield item
+
+    def due(self, slot):
+        return [(user_id, self.get(user_id)) for user_id in self.schedule.due(slot)]
+
+    def next_slot(self, slot):
+        return self.schedule.next_slot(slot)
+
+    def alert_cells(self):
+        return self.alerts.keys()
+
+    def alert_users(self, cell):
+        return list(self.alerts.get(cell))
+
+    def updated(self, changes):
+        # changes: {user_id: new setting}, returns the next snapshot
+        shards = list(self._shards)
+        copied = set()
+        slot_moves = []
+        cell_moves = []
+        for user_id, setting in changes.items():
+            i = hash(user_id) % SettingsSnapshot.SHARDS
+            if i not in copied:
+                shards[i] = dict(shards[i])
+                copied.add(i)
+            previous = shards[i].get(user_id)
+            slot_moves.append((user_id, schedule_slot(previous), schedule_slot(setting)))
+            cell_moves.append((user_id, alert_cell(previous), alert_cell(setting)))
+            shards[i][user_id] = setting
+        return SettingsSnapshot(
+            self.version + 1,
+            tuple(shards),
+            self.schedule.moved(slot_moves),
+            self.alerts.moved(cell_moves))
+
+
+class MemorySettingsStore:
+    # every setting in memory, written to a json file on close
+
+    def __init__(self, path=settings.USER_SETTINGS_PATH):
+        self.path = path
+        self._snapshot = SettingsSnapshot()
+        # writers take turns, readers use whatever snapshot is published
+        self._write_lock = threading.Lock()
+        self._changed = threading.Condition()
+        self.load()
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def snapshot(self):
+        return self._snapshot
+
+    def _publish(self, changes):
+        snapshot = self._snapshot.updated(changes)
+        with self._changed:
+            self._snapshot = snapshot
+            self._changed.notify_all()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            loaded = json.load(f)
+        changes = {}
+        for user_id, setting in loaded.items():
+            changes[user_id] = {k: setting[k] for k in FIELDS if setting.get(k) is not None}
+        # one snapshot for the whole file instead of one per user
+        with self._write_lock:
+            self._publish(changes)
+        logger.info('loaded user settings.')
+
+    def close(self):
+        with open(self.path, 'w') as f:
+            json.dump(dict(self._snapshot.items()), f)
+        logger.info('saved user settings.')
+
+    def get(self, user_id):
+        setting = self._snapshot.get(user_id)
+        if setting is None:
+            return None
+        return dict(setting)
+
+    def items(self):
+        return [(user_id, dict(setting)) for user_id, setting in self._snapshot.items()]
+
+    def update(self, user_id, latitude=None, longitude=None, schedule_hour=None, schedule_minute=None,
+        rain_alert=None):
+        # returns the previous setting, None for a new user
+        values = zip(FIELDS, (latitude, longitude, schedule_hour, schedule_minute, rain_alert))
+        with self._write_lock:
+            previous = self._snapshot.get(user_id)
+            setting = dict(previous or {})
+            setting.update((k, v) for k, v in values if v is not None)
+            self._publish({user_id: setting})
+        if previous is None:
+            return None
+        return dict(previous)
+
+    def due(self, slot):
+        return [(user_id, dict(setting)) for user_id, setting in self._snapshot.due(slot)]
+
+    def next_slot(self, slot):
+        return self._snapshot.next_slot(slot)
+
+    def alert_cells(self):
+        return self._snapshot.alert_cells()
+
+    def alert_users(self, cell):
+        return self._snapshot.alert_users(cell)
+
+    def wait(self, version, timeout=None):
+        # block until a newer snapshot is published or the timeout passes
+        with self._changed:
+            return self._changed.wait_for(lambda: self._snapshot.version != version, timeout)
+
+
+class SQLiteSettingsStore:
+    # settings in a SQLite database shared by every process on the host
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS user_settings ('
+        ' user_id TEXT PRIMARY KEY,'
+        ' latitude REAL,'
+        ' longitude REAL,'
+        ' schedule_slot INTEGER,'
+        ' rain_alert INTEGER,'
+        ' cell_latitude REAL,'
+        ' cell_longitude REAL)',
+        'CREATE INDEX IF NOT EXISTS user_settings_schedule'
+        ' ON user_settings (schedule_slot) WHERE schedule_slot IS NOT NULL',
+    )
+    # columns added after the first release, added to databases created before them
+    COLUMNS = (
+        ('rain_alert', 'INTEGER'),
+        # the forecast cell of the location, to find alert subscribers by cell
+        ('cell_latitude', 'REAL'),
+        ('cell_longitude', 'REAL'),
+    )
+    INDEXES = (
+        'CREATE INDEX IF NOT EXISTS user_settings_alert'
+        ' ON user_settings (cell_latitude, cell_longitude) WHERE rain_alert = 1',
+    )
+    SELECT = 'SELECT latitude, longitude, schedule_slot, rain_alert FROM user_settings'
+
+    def __init__(self, path=settings.SETTINGS_DB_PATH, import_path=settings.USER_SETTINGS_PATH):
+        self.path = path
+        self.version = 0
+        self._local = threading.local()
+        self._changed = threading.Condition()
+        db = self._db()
+        for statement in SQLiteSettingsStore.SCHEMA:
+            db.execute(statement)
+        self._migrate(db)
+        for statement in SQLiteSettingsStore.INDEXES:
+            db.execute(statement)
+        if import_path and len(self) == 0 and os.path.exists(import_path):
+            self._import(import_path)
+
+    def _db(self):
+        # sqlite connections can't be shared between threads
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(
+                self.path,
+                timeout=settings.SETTINGS_DB_TIMEOUT,
+                isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def _missing_columns(self, db):
+        columns = set(row[1] for row in db.execute('PRAGMA table_info(user_settings)'))
+        return [c for c in SQLiteSettingsStore.COLUMNS if c[0] not in columns]
+
+    def _migrate(self, db):
+        if not self._missing_columns(db):
+            return
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # another process may have migrated while we waited for the lock
+            missing = self._missing_columns(db)
+            if not missing:
+                db.execute('COMMIT')
+                return
+            for name, type in missing:
+                db.execute('ALTER TABLE user_settings ADD COLUMN {} {}'.format(name, type))
+            # cells are rounded like location_key, which SQLite's round() doesn't match
+            rows = db.execute(
+                'SELECT user_id, latitude, longitude FROM user_settings'
+                ' WHERE latitude IS NOT NULL AND longitude IS NOT NULL').fetchall()
+            for user_id, latitude, longitude in rows:
+                db.execute(
+                    'UPDATE user_settings SET cell_latitude = ?, cell_longitude = ? WHERE user_id = ?',
+                    shigurecache.location_key(latitude, longitude) + (user_id,))
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        logger.info('added columns %s to %s.', [c[0] for c in missing], self.path)
+
+    def _import(self, path):
+        # one-off migration from the old usersettings.json
+        with open(path) as f:
+            loaded = json.load(f)
+        for user_id, setting in loaded.items():
+            self.update(user_id, **{k: setting.get(k) for k in FIELDS})
+        logger.info('imported %d user settings from %s.', len(loaded), path)
+
+    def __len__(self):
+        return self._db().execute('SELECT COUNT(*) FROM user_settings').fetchone()[0]
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    def _setting(self, row):
+        latitude, longitude, slot, rain_alert = row
+        setting = {}
+        if latitude is not None:
+            setting['latitude'] = latitude
+        if longitude is not None:
+            setting['longitude'] = longitude
+        if slot is not None:
+            setting['schedule_hour'] = slot // 60
+            setting['schedule_minute'] = slot % 60
+        if rain_alert is not None:
+            setting['rain_alert'] = bool(rain_alert)
+        return setting
+
+    def get(self, user_id):
+        row = self._db().execute(
+            SQLiteSettingsStore.SELECT + ' WHERE user_id = ?',
+            (user_id,)).fetchone()
+        if row is None:
+            return None
+        return self._setting(row)
+
+    def items(self):
+        cursor = self._db().execute(
+            'SELECT user_id, latitude, longitude, schedule_slot, rain_alert FROM user_settings')
+        for row in cursor:
+            yield row[0], self._setting(row[1:])
+
+    def update(self, user_id, latitude=None, longitude=None, schedule_hour=None, schedule_minute=None,
+        rain_alert=None):
+        # returns the previous setting, None for a new user
+        slot = None
+        if schedule_hour is not None and schedule_minute is not None:
+            slot = schedule_hour * 60 + schedule_minute
+        cell = (None, None)
+        if latitude is not None and longitude is not None:
+            cell = shigurecache.location_key(latitude, longitude)
+        if rain_alert is not None:
+            rain_alert = int(rain_alert)
+        db = self._db()
+        # take the write lock before reading so concurrent upserts don't interleave
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute(
+                SQLiteSettingsStore.SELECT + ' WHERE user_id = ?',
+                (user_id,)).fetchone()
+            if row is None:
+                db.execute(
+                    'INSERT INTO user_settings'
+                    ' (user_id, latitude, longitude, schedule_slot, rain_alert, cell_latitude, cell_longitude)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (user_id, latitude, longitude, slot, rain_alert) + cell)
+            else:
+                db.execute(
+                    'UPDATE user_settings SET'
+                    ' latitude = COALESCE(?, latitude),'
+                    ' longitude = COALESCE(?, longitude),'
+                    ' schedule_slot = COALESCE(?, schedule_slot),'
+                    ' rain_alert = COALESCE(?, rain_alert),'
+                    ' cell_latitude = COALESCE(?, cell_latitude),'
+                    ' cell_longitude = COALESCE(?, cell_longitude)'
+                    ' WHERE user_id = ?',
+                    (latitude, longitude, slot, rain_alert) + cell + (user_id,))
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        with self._changed:
+            self.version += 1
+            self._changed.notify_all()
+        if row is None:
+            return None
+        return self._setting(row)
+
+    def due(self, slot):
+        cursor = self._db().execute(
+            'SELECT user_id, latitude, longitude, schedule_slot, rain_alert FROM user_settings'
+            ' WHERE schedule_slot = ?',
+            (slot,))
+        return [(row[0], self._setting(row[1:])) for row in cursor]
+
+    def alert_cells(self):
+        # forecast cells with at least one rain alert subscriber
+        cursor = self._db().execute(
+            'SELECT DISTINCT cell_latitude, cell_longitude FROM user_settings'
+            ' WHERE rain_alert = 1 AND cell_latitude IS NOT NULL')
+        return [tuple(row) for row in cursor]
+
+    def alert_users(self, cell):
+        cursor = self._db().execute(
+            'SELECT user_id FROM user_settings'
+            ' WHERE rain_alert = 1 AND cell_latitude = ? AND cell_longitude = ?',
+            cell)
+        return [row[0] for row in cursor]
+
+    def next_slot(self, slot):
+        # first occupied slot at or after the given one, wrapping at midnight
+        db = self._db()
+        slot %= ScheduleIndex.MINUTES_PER_DAY
+        row = db.execute(
+            'SELECT MIN(schedule_slot) FROM user_settings WHERE schedule_slot >= ?',
+            (slot,)).fetchone()
+        if row[0] is None:
+            row = db.execute('SELECT MIN(schedule_slot) FROM user_settings').fetchone()
+        return row[0]
+
+    def wait(self, version, timeout=None):
+        # other processes can't wake us up, so poll at least every SETTINGS_POLL_INTERVAL
+        if timeout is None or timeout > settings.SETTINGS_POLL_INTERVAL:
+            timeout = settings.SETTINGS_POLL_INTERVAL
+        with self._changed:
+            return self._changed.wait_for(lambda: self.version != version, timeout)
+
+
+def open_store(backend=settings.SETTINGS_STORE):
+    if backend == 'sqlite':
+        return SQLiteSettingsStore()
+    if backend == 'memory':
+        return MemorySettingsStore()
+    raise ValueError('unknown settings store: {}'.format(backend))
@@ -0,0 +1,304 @@
+"""Sampled per-request tracing and an on-demand sampling profiler.
+
+A sampled webhook request records how long each stage took (signature check
+and parsing, settings lookup, forecast fetch with HTTP, JSON decoding and
+parsing, rendering, the reply call) and is written as one JSON line to
+stderr, a file or a local collector at udp://host:port (TRACE_EXPORT).
+Requests left out of the sample only pay for a thread local lookup per stage.
+
+    with shiguretrace.trace('webhook'):      # root, or a child of a running trace
+        with shiguretrace.span('parse'):     # no-op without a running trace
+            ...
+
+Code on an event loop can't use the thread local trace, it keeps the Trace
+from start() and opens spans on it.
+
+The admin endpoints of the web apps (enabled by ADMIN_TOKEN) run the
+profiler for a few seconds and change the sample rate of a running process:
+
+    curl -H 'Authorization: Bearer <token>' 'http://host/admin/profile?seconds=10' > stacks.txt
+    curl -X POST -H 'Authorization: Bearer <token>' 'http://host/admin/trace?rate=0.5'
+
+The profile is in the folded format of flamegraph.pl and speedscope.
+"""
+
+import collections
+import functools
+import hmac
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+import settings
+import shigurelog
+import shigurestats
+
+logger = shigurelog.get_logger('trace')
+
+TRACES_EXPORTED = shigurestats.counter(
+    'shigure_traces_exported_total', 'Sampled request traces written out')
+
+
+class _Noop:
+    # stands in for spans and traces of requests left out of the sample
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def span(self, name, **attrs):
+        return self
+
+    def set(self, **attrs):
+        pass
+
+
+NOOP = _Noop()
+
+
+class _Span:
+
+    __slots__ = ('trace', 'record')
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        # name, parent index, start, end, attributes
+        self.record = [name, -1, 0.0, 0.0, attrs]
+
+    def __enter__(self):
+        trace = self.trace
+        if trace._stack:
+            self.record[1] = trace._stack[-1]
+        trace._stack.append(len(trace.spans))
+        trace.spans.append(self.record)
+        self.record[2] = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.record[3] = time.perf_counter()
+        if exc_type is not None:
+            self.record[4]['error'] = exc_type.__name__
+        trace = self.trace
+        trace._stack.pop()
+        if not trace._stack:
+            trace.finish()
+        return False
+
+    def set(self, **attrs):
+        self.record[4].update(attrs)
+
+
+class Trace:
+    # the spans of one request, opened and closed by one thread or task.
+    # the first span is the root, the trace is exported when it closes
+
+    def __init__(self, exporter, bound=False):
+        self.id = '{:016x}'.format(random.getrandbits(64))
+        self.time = time.time()
+        self.exporter = exporter
+        self.bound = bound
+        self.spans = []
+        self._stack = []
+
+    def span(self, name, **attrs):
+        return _Span(self, name, attrs)
+
+    def record(self):
+        origin = self.spans[0][2]
+        spans = []
+        for name, parent, start, end, attrs in self.spans:
+            span = {
+                'name': name,
+                'parent': parent,
+                'start_ms': round((start - origin) * 1000, 3),
+                'duration_ms': round((end - start) * 1000, 3),
+            }
+            if attrs:
+                span['attrs'] = attrs
+            spans.append(span)
+        return {
+            'trace': self.id,
+            'name': spans[0]['name'],
+            'time': self.time,
+            'duration_ms': spans[0]['duration_ms'],
+            'pid': os.getpid(),
+            'spans': spans,
+        }
+
+    def finish(self):
+        if self.bound:
+            _local.trace = None
+        try:
+            self.exporter.export(self.record())
+        except Exception:
+            logger.exception('failed to export trace %s', self.id)
+            return
+        TRACES_EXPORTED.inc()
+
+
+class JSONLExporter:
+    # one line per trace, appended in a single write so processes can share the file
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def export(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = sys.stderr if self.path == '-' else open(self.path, 'a', encoding='utf-8')
+            self._file.write(line)
+            self._file.flush()
+
+
+class UDPExporter:
+    # one datagram per trace to a collector on the host, never blocks a request
+
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.dropped = 0
+
+    def export(self, record):
+        try:
+            self.socket.sendto(json.dumps(record, ensure_ascii=False).encode('utf-8'), self.address)
+        except OSError:
+            self.dropped += 1
+
+
+def open_exporter(target=settings.TRACE_EXPORT):
+    # 'udp://host:port' for a collector, '-' for stderr, otherwise a file path
+    if target.startswith('udp://'):
+        host, port = target[len('udp://'):].rsplit(':', 1)
+        return UDPExporter(host, int(port))
+    return JSONLExporter(target)
+
+
+# changed at runtime from /admin/trace
+sample_rate = settings.TRACE_SAMPLE_RATE
+exporter = None
+_local = threading.local()
+
+
+def sampled():
+    global exporter
+    if not sample_rate or random.random() >= sample_rate:
+        return False
+    if exporter is None:
+        exporter = open_exporter()
+    return True
+
+
+def start():
+    # a Trace for code that can't use the thread local one, NOOP when not sampled
+    if not sampled():
+        return NOOP
+    return Trace(exporter)
+
+
+def trace(name, **attrs):
+    # a span under the trace running on this thread, or the root of a new
+    # one when the request is sampled
+    t = getattr(_local, 'trace', None)
+    if t is None:
+        if not sampled():
+            return NOOP
+        t = _local.trace = Trace(exporter, bound=True)
+    return t.span(name, **attrs)
+
+
+def span(name, **attrs):
+    t = getattr(_local, 'trace', None)
+    if t is None:
+        return NOOP
+    return t.span(name, **attrs)
+
+
+def traced(name):
+    # runs the decorated function in trace(name)
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with trace(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler:
+    # counts the stacks of every other thread every interval seconds. it
+    # measures wall clock time, threads waiting on I/O or locks show up too
+
+    def __init__(self, interval=settings.PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+
+    def run(self, seconds):
+        stacks = collections.Counter()
+        me = threading.get_ident()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        return stacks
+
+
+def folded(stacks):
+    return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
+
+
+_profiling = threading.Lock()
+
+
+def profile(seconds):
+    # folded stacks sampled for seconds, None while another profile is running
+    if not _profiling.acquire(blocking=False):
+        return None
+    try:
+        seconds = max(0, min(seconds, settings.PROFILE_MAX_SECONDS))
+        logger.info('profiling for %s seconds', seconds)
+        return folded(SamplingProfiler().run(seconds))
+    finally:
+        _profiling.release()
+
+
+def admin(name, method, params, authorization):
+    # (HTTP status, text) of the admin endpoints, shared by both web apps.
+    # this blocks while profiling
+    global sample_rate
+    if not settings.ADMIN_TOKEN:
+        return 404, 'Not Found'
+    if not hmac.compare_digest(authorization or '', 'Bearer ' + settings.ADMIN_TOKEN):
+        return 403, 'Forbidden'
+    try:
+        if name == 'profile':
+            stacks = profile(float(params.get('seconds', 10)))
+            if stacks is None:
+                return 409, 'a profile is already running'
+            return 200, stacks
+        if name == 'trace':
+            if method == 'POST' and 'rate' in params:
+                sample_rate = min(max(float(params['rate']), 0.0), 1.0)
+                logger.info('trace sample rate set to %s', sample_rate)
+            return 200, 'sample rate: {}\n'.format(sample_rate)
+    except ValueError:
+        return 400, 'Bad Request'
+    return 404, 'Not Found'
@@ -0,0 +1,217 @@
+import random
+import threading
+import time
+
+import settings
+import shigurelimit
+import shigurelog
+import shiguretrace
+
+try:
+    # optional, decodes the 48 hour forecast several times faster
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+
+logger = shigurelog.get_logger('weather')
+
+QUERY = {
+    'language': 'en-US',
+    'units': 'm'
+}
+
+
+def backoff(attempt, base, maximum):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def retry_after(headers):
+    # seconds from a Retry-After header, None if missing or not a number
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        return None
+
+
+class BaseWeatherClient:
+    # the retry, back off and budget decisions of a weather client, shared by
+    # WeatherClient and shigureasync.AsyncWeatherClient which only do the I/O:
+    #
+    #     if self.blocked(): return 403, None
+    #     for each attempt:
+    #         if not self.admit(priority): return 429, None
+    #         status, headers, error = request()     # status None on network errors
+    #         if status == 200: self.succeeded(); return 200, decoded
+    #         wait = self.retry_wait(attempt, status, headers, error)
+    #         if wait is None: return status, None
+    #         sleep(wait)
+
+    # HTTP status codes worth another try
+    RETRY_STATUS = (500, 502, 503, 504)
+    RATE_LIMIT_STATUS = (403, 429)
+
+    def __init__(self,
+        endpoint=settings.WEATHER_ENDPOINT,
+        username=settings.WEATHER_USERNAME,
+        password=settings.WEATHER_PASSWORD,
+        max_retries=settings.WEATHER_MAX_RETRIES,
+        backoff_base=settings.WEATHER_BACKOFF_BASE,
+        backoff_max=settings.WEATHER_BACKOFF_MAX,
+        max_retry_after=settings.WEATHER_MAX_RETRY_AFTER,
+        limiter=shigurelimit.weather_limiter
+        ):
+        self.endpoint = endpoint
+        self.username = username
+        self.password = password
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self.limiter = limiter
+
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.over_budget = 0
+        self._blocked_until = 0
+        self._lock = threading.Lock()
+
+    def url(self, latitude, longitude):
+        return self.endpoint.format(
+            username=self.username,
+            password=self.password,
+            latitude=latitude,
+            longitude=longitude)
+
+    def blocked(self):
+        # the service told us to back off, don't ask again until then
+        if time.time() < self._blocked_until:
+            with self._lock:
+                self.rate_limited += 1
+            return True
+        return False
+
+    def admit(self, priority):
+        # takes a request from the budget of the priority, False when it is spent
+        if self.limiter is not None and not self.limiter.acquire(priority):
+            with self._lock:
+                self.over_budget += 1
+            return False
+        with self._lock:
+            self.requests += 1
+        return True
+
+    def succeeded(self):
+        if self.limiter is not None:
+            self.limiter.recover()
+
+    def retry_wait(self, attempt, status, headers, error=None):
+        # seconds to wait before trying again after a failed attempt, None to
+        # give up. status is None when error kept us from getting a responce
+        if status is None:
+            if attempt >= self.max_retries:
+                logger.warning('weather request failed: %r', error)
+                with self._lock:
+                    self.failures += 1
+                return None
+            wait = backoff(attempt, self.backoff_base, self.backoff_max)
+        elif status in BaseWeatherClient.RATE_LIMIT_STATUS:
+            if self.limiter is not None:
+                self.limiter.throttle()
+            wait = retry_after(headers)
+            if wait is None:
+                return None
+            self._blocked_until = time.time() + wait
+            if attempt >= self.max_retries or wait > self.max_retry_after:
+                return None
+        elif status in BaseWeatherClient.RETRY_STATUS:
+            if attempt >= self.max_retries:
+                return None
+            wait = backoff(attempt, self.backoff_base, self.backoff_max)
+        else:
+            return None
+        with self._lock:
+            self.retries += 1
+        return wait
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'failures': self.failures,
+            'rate_limited': self.rate_limited,
+            'over_budget': self.over_budget,
+        }
+
+
+class WeatherClient(BaseWeatherClient):
+
+    def __init__(self,
+        connect_timeout=settings.WEATHER_CONNECT_TIMEOUT,
+        read_timeout=settings.WEATHER_READ_TIMEOUT,
+        pool_size=settings.WEATHER_POOL_SIZE,
+        **kwargs
+        ):
+        super(WeatherClient, self).__init__(**kwargs)
+        self.timeout = (connect_timeout, read_timeout)
+
+        # imported with the first client, requests takes longer to import than the bot itself
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.network_errors = (requests.Timeout, requests.ConnectionError)
+
+        # one keep-alive connection pool shared by every thread
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def hourly(self, latitude, longitude, priority=shigurelimit.INTERACTIVE):
+        # returns (HTTP status, decoded json), status is None when the
+        # service could not be reached at all and 429 when our own
+        # budget for the priority is spent
+        if self.blocked():
+            return 403, None
+        url = self.url(latitude, longitude)
+        attempt = 0
+        while True:
+            if not self.admit(priority):
+                return 429, None
+            status = headers = error = None
+            try:
+                with shiguretrace.span('weather.http', attempt=attempt):
+                    responce = self.session.get(url, params=QUERY, timeout=self.timeout)
+            except self.network_errors as e:
+                error = e
+            else:
+                status = responce.status_code
+                if status == 200:
+                    self.succeeded()
+                    with shiguretrace.span('weather.decode', bytes=len(responce.content)):
+                        return status, loads(responce.content)
+                headers = responce.headers
+            wait = self.retry_wait(attempt, status, headers, error)
+            if wait is None:
+                return status, None
+            attempt += 1
+            time.sleep(wait)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def weather_client():
+    # the client shared by the process, created on first use
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = WeatherClient()
+    return _client